@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""
+Offline analysis of candump archives with the U-BMS decoder of ubmsbattery.py.
+Files are processed in parallel by a pool of processes, each file is streamed line by line (plain, .gz or
+.xz) and every interface in it is treated as one pack. Lines are parsed without can.Message objects and
+frames the decoder does not use are skipped before their data is converted.
+
+Per pack it reports cell voltage min/max/spread overall and per time step, module temperature extremes,
+Ah and kWh charged and discharged, shutdown reasons (0xC0 byte 7) and the time modules were balancing.
+With --telemetry the decoded values of every snapshot are also written as columnar file per pack.
+
+ python3 analyze.py -j 8 -o summary.json /data/logs/*.log.gz
+
+"""
+
+import gzip
+import json
+import logging
+import lzma
+import os
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from telemetryfile import TelemetryWriter
+from ubmsbattery import TopologyDiscovery, UbmsBattery
+
+# snapshots further apart (log gap, BMS off) do not count towards balancing time
+MAX_GAP = 5.0
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rt")
+    return open(path)
+
+
+def read_frames(path):
+    # (timestamp, interface, ID, data as hex) of the standard data frames of a candump -l log
+    with open_log(path) as log:
+        for line in log:
+            try:
+                timestamp, channel, frame = line.split()
+            except ValueError:
+                continue
+            canId, _, data = frame.partition("#")
+            if len(canId) != 3 or data[:1] in ("R", "#"):
+                # extended, remote and CAN FD frames are not used by the U-BMS
+                continue
+            try:
+                yield float(timestamp[1:-1]), channel, int(canId, 16), data
+            except ValueError:
+                continue
+
+
+class PackAnalysis:
+    def __init__(self, name, voltage, capacity, step, topology, telemetry=None):
+        self.name = name
+        self.voltage = voltage
+        self.capacity = capacity
+        self.step = step
+        # modules, strings, cells per module given on the command line
+        self.topology = topology
+        # path of a telemetry file to write the snapshots to, see telemetryfile.py
+        self.telemetry = telemetry
+        self._writer = None
+        self.bat = None
+        self._ids = None
+        self._pending = []
+        self._discovery = TopologyDiscovery()
+        self.frames = 0
+        self.first = self.last = None
+        self.cellMin = self.cellMax = None
+        self.spreadMax = 0.0
+        self.tempMin = self.tempMax = None
+        self.shutdowns = {}
+        self.balancing = 0.0
+        self.moduleBalancing = 0.0
+        # time step start -> [min cell, max cell, max spread]
+        self.steps = {}
+        self._lastSnapshot = None
+        self._shutdownReason = 0
+
+    def add(self, timestamp, canId, data):
+        if self.bat is None:
+            # frames are kept until the pack layout is known, as the service does on the bus
+            self._pending.append((timestamp, canId, data))
+            self._discovery.add(canId, bytes.fromhex(data))
+            if self._discovery.complete:
+                self._start()
+            return
+        if canId in self._ids:
+            self.frames += 1
+            self.bat.decode(timestamp, canId, bytes.fromhex(data))
+
+    def _start(self):
+        # create the decoder for the discovered layout, then decode the frames read so far
+        modules, strings, cellsPerModule = self.topology
+        self.bat = UbmsBattery(
+            voltage=self.voltage,
+            capacity=self.capacity,
+            connection=self.name,
+            verify=False,
+            modules=modules,
+            strings=strings,
+            cellsPerModule=cellsPerModule,
+            discovered=self._discovery.result(),
+        )
+        self.bat.onSnapshot = self._snapshot
+        self._ids = set(self.bat.stats.ids)
+        if self.telemetry:
+            self._writer = TelemetryWriter(
+                self.telemetry, self.bat.numberOfModules, self.bat.cellsPerModule
+            )
+        pending, self._pending = self._pending, None
+        for frame in pending:
+            self.add(*frame)
+
+    def finish(self):
+        if self.bat is None and self._pending:
+            self._start()
+        if self._writer is not None:
+            self._writer.close()
+
+    def _snapshot(self):
+        snap = self.bat.snapshot
+        timestamp = snap.timestamp
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+
+        previous, self._lastSnapshot = self._lastSnapshot, timestamp
+        if snap.version < 2:
+            # the log may start in the middle of a cycle
+            return
+        if self._writer is not None:
+            self._writer.add(snap)
+        dt = timestamp - previous
+        if snap.numberOfModulesBalancing and 0 < dt <= MAX_GAP:
+            self.balancing += dt
+            self.moduleBalancing += dt * snap.numberOfModulesBalancing
+
+        if snap.shutdownReason != self._shutdownReason and snap.shutdownReason:
+            reason = "0x%02x" % snap.shutdownReason
+            self.shutdowns[reason] = self.shutdowns.get(reason, 0) + 1
+        self._shutdownReason = snap.shutdownReason
+
+        low, high = snap.minCellVoltage, snap.maxCellVoltage
+        spread = round(high - low, 3)
+        if self.cellMin is None or low < self.cellMin:
+            self.cellMin = low
+        if self.cellMax is None or high > self.cellMax:
+            self.cellMax = high
+        if spread > self.spreadMax:
+            self.spreadMax = spread
+        start = int(timestamp // self.step) * self.step
+        bucket = self.steps.get(start)
+        if bucket is None:
+            self.steps[start] = [low, high, spread]
+        else:
+            bucket[0] = min(bucket[0], low)
+            bucket[1] = max(bucket[1], high)
+            bucket[2] = max(bucket[2], spread)
+
+        temperatures = [t for t in snap.moduleTemp if t]
+        if temperatures:
+            low, high = min(temperatures), max(temperatures)
+            if self.tempMin is None or low < self.tempMin:
+                self.tempMin = low
+            if self.tempMax is None or high > self.tempMax:
+                self.tempMax = high
+
+    def summary(self):
+        bat = self.bat
+        energy = bat.energy
+        return {
+            "interface": self.name,
+            "modules": bat.numberOfModules,
+            "strings": bat.numberOfStrings,
+            "cellsPerModule": bat.cellsPerModule,
+            "frames": self.frames,
+            "cycles": bat.snapshot.version,
+            "start": self.first,
+            "end": self.last,
+            "cellVoltageMin": self.cellMin,
+            "cellVoltageMax": self.cellMax,
+            "cellSpreadMax": self.spreadMax,
+            "moduleTemperatureMin": self.tempMin,
+            "moduleTemperatureMax": self.tempMax,
+            "chargedAh": energy.chargedAh,
+            "dischargedAh": energy.dischargedAh,
+            "chargedKWh": energy.chargedWh * 0.001,
+            "dischargedKWh": energy.dischargedWh * 0.001,
+            "shutdownReasons": self.shutdowns,
+            "balancingSeconds": self.balancing,
+            "moduleBalancingSeconds": self.moduleBalancing,
+            "telemetry": self.telemetry,
+            # [step start, min cell, max cell, max spread] in V
+            "steps": [[start] + values for start, values in sorted(self.steps.items())],
+        }
+
+
+def analyze_file(path, voltage, capacity, step, topology, telemetry=None):
+    # summaries of all packs in one log, runs in a worker process
+    start = time.monotonic()
+    packs = {}
+    for timestamp, channel, canId, data in read_frames(path):
+        pack = packs.get(channel)
+        if pack is None:
+            telemetryPath = None
+            if telemetry:
+                name = os.path.basename(path).split(".")[0]
+                telemetryPath = os.path.join(telemetry, "%s-%s.ubt" % (name, channel))
+            pack = packs[channel] = PackAnalysis(
+                channel, voltage, capacity, step, topology, telemetryPath
+            )
+        pack.add(timestamp, canId, data)
+    summaries = []
+    for pack in packs.values():
+        pack.finish()
+        summary = pack.summary()
+        summary["file"] = path
+        summaries.append(summary)
+    logging.info("%s analyzed in %.1fs", path, time.monotonic() - start)
+    return summaries
+
+
+# === All code below is to run the analysis from the commandline ===
+def main():
+    parser = ArgumentParser(description="analyze candump logs of U-BMS packs")
+    parser.add_argument("logs", nargs="+", help="candump -l logs, also .gz or .xz")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="parallel processes, default one per CPU",
+    )
+    parser.add_argument(
+        "--step",
+        type=float,
+        default=3600,
+        help="seconds per entry of the cell voltage history, default 3600",
+    )
+    parser.add_argument(
+        "-c", "--capacity", type=int, default=650, help="capacity in Ah"
+    )
+    parser.add_argument(
+        "-v", "--voltage", type=float, default=29.0, help="maximum charge voltage V"
+    )
+    parser.add_argument(
+        "--modules", type=int, help="number of modules, default from the log"
+    )
+    parser.add_argument(
+        "--strings",
+        type=int,
+        help="number of parallel strings, default from the voltage",
+    )
+    parser.add_argument(
+        "--cells", type=int, help="cells per module, default from the log"
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the summaries as json to this file"
+    )
+    parser.add_argument(
+        "-t",
+        "--telemetry",
+        help="directory to write the decoded values of each pack to, see telemetryfile.py",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)-8s %(message)s", level=logging.INFO)
+
+    # largest files first, so no worker is left with a big one at the end
+    logs = sorted(args.logs, key=lambda path: -os.path.getsize(path))
+    topology = (args.modules, args.strings, args.cells)
+    start = time.monotonic()
+    summaries = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [
+            pool.submit(
+                analyze_file,
+                path,
+                args.voltage,
+                args.capacity,
+                args.step,
+                topology,
+                args.telemetry,
+            )
+            for path in logs
+        ]
+        for future in futures:
+            summaries += future.result()
+    elapsed = time.monotonic() - start
+
+    summaries.sort(key=lambda summary: (summary["file"], summary["interface"]))
+    for s in summaries:
+        logging.info(
+            "%s %s: %d frames, cells %.3f-%.3fV (spread %.3fV), modules %s-%sC, "
+            "+%.1f/-%.1fAh, balancing %.0fs, shutdowns %s",
+            s["file"],
+            s["interface"],
+            s["frames"],
+            s["cellVoltageMin"] or 0,
+            s["cellVoltageMax"] or 0,
+            s["cellSpreadMax"],
+            s["moduleTemperatureMin"],
+            s["moduleTemperatureMax"],
+            s["chargedAh"],
+            s["dischargedAh"],
+            s["balancingSeconds"],
+            s["shutdownReasons"] or "none",
+        )
+    frames = sum(s["frames"] for s in summaries)
+    logging.info(
+        "%d files, %d frames in %.1fs, %.0f frames/s",
+        len(logs),
+        frames,
+        elapsed,
+        frames / elapsed,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent=1)
+    else:
+        print(json.dumps(summaries, indent=1))
+
+
+if __name__ == "__main__":
+    main()
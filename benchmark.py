@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the frame decoder and the dbus update, using the candump logs in candumps/ as fixed input.
+Results are written as json and can be compared against a stored baseline, a metric that got worse by
+more than the tolerance is reported and makes the run fail.
+
+ python3 benchmark.py --save-baseline baseline.json
+ python3 benchmark.py --baseline baseline.json
+
+Metrics ending in _per_s are better when higher, all others (times) are better when lower.
+The _update benchmarks publish into the in-process stand-ins of fakedbus.py, so they run anywhere and never
+register a service or write localsettings on the target.
+
+"""
+
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from time import monotonic
+
+import fakedbus
+
+from canbatch import CAN_FRAME
+from canreplay import CandumpBus, read_candump
+from ubmsbattery import UbmsBattery
+
+CANDUMPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "candumps")
+
+
+def _replayed_battery(path, voltage, capacity):
+    # a battery that went through discovery on the log, with the notifier done replaying it
+    bus = CandumpBus(path, speed=0)
+    bat = UbmsBattery(voltage=voltage, capacity=capacity, connection="bench", bus=bus)
+    bus.finished.wait()
+    return bat
+
+
+def _batch(frames, minimum=5000):
+    # repeat short logs so a single run is long enough to be timed reliably
+    return frames * max(1, -(-minimum // len(frames)))
+
+
+def _raw_bursts(frames, size):
+    # pack messages into can_frame buffers of size frames, as read by canbatch.RawFrameReader
+    bursts = []
+    for i in range(0, len(frames), size):
+        burst = frames[i : i + size]
+        buffer = bytearray()
+        for msg in burst:
+            canId = msg.arbitration_id | (0x80000000 if msg.is_extended_id else 0)
+            buffer += CAN_FRAME.pack(canId, msg.dlc, bytes(msg.data))
+        bursts.append((buffer, len(burst), burst[-1].timestamp))
+    return bursts
+
+
+def _timed(func, repeat):
+    # best wall and cpu time of repeat runs, in seconds
+    wall = cpu = float("inf")
+    for i in range(repeat):
+        w0 = time.perf_counter()
+        c0 = time.thread_time()
+        func()
+        cpu = min(cpu, time.thread_time() - c0)
+        wall = min(wall, time.perf_counter() - w0)
+    return wall, cpu
+
+
+def bench_decode(dumps, args, results):
+    perId = defaultdict(list)
+    for path in dumps:
+        name = os.path.splitext(os.path.basename(path))[0]
+        frames = list(read_candump(path))
+        for msg in frames:
+            perId[msg.arbitration_id].append(msg)
+
+        bat = _replayed_battery(path, args.voltage, args.capacity)
+        decode = bat.on_message_received
+        frames = _batch(frames)
+
+        def run():
+            for msg in frames:
+                decode(msg)
+
+        wall, cpu = _timed(run, args.repeat)
+        results["decode.%s.frames_per_s" % name] = len(frames) / wall
+        results["decode.%s.cpu_ns_per_frame" % name] = cpu * 1e9 / len(frames)
+
+        # the same frames as raw socketcan batches of a U-BMS burst
+        bursts = _raw_bursts(frames, args.burst)
+        on_frames = bat.on_frames
+
+        def run():
+            for buffer, count, timestamp in bursts:
+                on_frames(buffer, count, timestamp)
+
+        wall, cpu = _timed(run, args.repeat)
+        results["decode_batch.%s.frames_per_s" % name] = len(frames) / wall
+        results["decode_batch.%s.cpu_ns_per_frame" % name] = cpu * 1e9 / len(frames)
+        bat.shutdown()
+
+    # per arbitration ID cost, in the order the frames appeared
+    bat = _replayed_battery(dumps[0], args.voltage, args.capacity)
+    decode = bat.on_message_received
+    for canId, frames in sorted(perId.items()):
+        frames = _batch(frames, 1000)
+
+        def run():
+            for msg in frames:
+                decode(msg)
+
+        wall, cpu = _timed(run, args.repeat)
+        results["decode_id.0x%03X.ns_per_frame" % canId] = wall * 1e9 / len(frames)
+    bat.shutdown()
+
+
+def bench_update(dumps, args, results):
+    fakedbus.install()
+    from dbus_ubms import DbusBatteryService
+
+    service = DbusBatteryService(
+        servicename="com.victronenergy.battery",
+        connection="bench",
+        deviceinstance=args.instance,
+        capacity=args.capacity,
+        voltage=args.voltage,
+        bus=CandumpBus(dumps[0], speed=0),
+        serviceClass=fakedbus.FakeVeDbusService,
+        settingsFactory=fakedbus.FakeSettingsDevice,
+        connectionFactory=fakedbus.connection,
+    )
+    service._bat._ci.finished.wait()
+    bat = service._bat
+
+    # the snapshots of a second pass over the log, so the updates publish changing values
+    snapshots = []
+    for msg in read_candump(dumps[0]):
+        bat.on_message_received(msg)
+        if msg.arbitration_id == 0xC0:
+            snapshots.append(bat.snapshot)
+
+    def run(slow):
+        # complete _updates incl. the flush emitting the dbus signals, one per snapshot, forcing
+        # the fast path and the slow path or not
+        for snap in snapshots:
+            bat.snapshot = snap
+            service.lastVersion = -1
+            service.lastSlowUpdate = float("-inf") if slow else monotonic()
+            service._update()
+
+    for name, slow in (("fast", False), ("slow", True)):
+        wall, cpu = _timed(lambda: run(slow), args.repeat)
+        results["update.%s.wall_us" % name] = wall * 1e6 / len(snapshots)
+        results["update.%s.cpu_us" % name] = cpu * 1e6 / len(snapshots)
+    bat.shutdown()
+
+
+def compare(results, baseline, tolerance):
+    # returns the metrics that regressed by more than the tolerance
+    regressions = []
+    for metric, value in sorted(results.items()):
+        base = baseline.get(metric)
+        if not base:
+            continue
+        change = value / base - 1
+        if metric.endswith("_per_s"):
+            change = -change
+        logging.info("%-45s %12.1f %12.1f %+6.1f%%", metric, base, value, 100 * change)
+        if change > tolerance:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="dbus_ubms benchmarks", add_help=True)
+    parser.add_argument(
+        "dumps", nargs="*", help="candump logs to use, default all in candumps/"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=20, help="repetitions, best is taken"
+    )
+    parser.add_argument(
+        "--burst", type=int, default=20, help="frames per batch for batched decoding"
+    )
+    parser.add_argument("-o", "--output", help="write results to this json file")
+    parser.add_argument("-b", "--baseline", help="compare to this json results file")
+    parser.add_argument(
+        "--save-baseline", help="write results as new baseline to this file"
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative regression, default 0.1",
+    )
+    parser.add_argument(
+        "-c", "--capacity", type=int, default=650, help="capacity in Ah"
+    )
+    parser.add_argument(
+        "-v", "--voltage", type=float, default=29.0, help="maximum charge voltage V"
+    )
+    parser.add_argument(
+        "--instance", type=int, default=99, help="device instance for _update runs"
+    )
+    args = parser.parse_args()
+
+    # the decoder logs at debug level on every frame, keep that out of the measurement
+    logging.basicConfig(format="%(levelname)-8s %(message)s", level=logging.INFO)
+
+    dumps = args.dumps or sorted(glob.glob(os.path.join(CANDUMPS, "*.log")))
+    results = {}
+    bench_decode(dumps, args, results)
+    bench_update(dumps, args, results)
+
+    report = {
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "time": time.time(),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logging.error("Regressions: %s", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
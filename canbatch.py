@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Batched reception of raw SocketCAN frames.
+Per wakeup all frames waiting on the socket are read into one reused buffer and handed to the decoder
+as a batch, no can.Message is created per frame. The U-BMS sends its frames in bursts of about 20.
+
+"""
+
+import logging
+import select
+import socket
+import struct
+import threading
+import time
+
+# struct can_frame of linux/can.h: can_id (incl. EFF/RTR/ERR flags), len, padding, data
+CAN_FRAME = struct.Struct("=IB3x8s")
+CAN_FRAME_HEADER = struct.Struct("=IB")
+CAN_FRAME_DATA = 8
+
+
+class RawFrameReader:
+    def __init__(self, sock, batchSize=64):
+        self.socket = sock
+        self.buffer = bytearray(CAN_FRAME.size * batchSize)
+        view = memoryview(self.buffer)
+        self._slots = [
+            view[i : i + CAN_FRAME.size]
+            for i in range(0, len(self.buffer), CAN_FRAME.size)
+        ]
+
+    def read(self):
+        # fill the buffer with the frames waiting on the socket, returns the number of frames
+        recv_into = self.socket.recv_into
+        count = 0
+        for slot in self._slots:
+            try:
+                recv_into(slot, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            count += 1
+        return count
+
+
+class BatchReceiver(threading.Thread):
+    # takes the place of can.Notifier for raw sockets, calls drain whenever the socket is readable
+    def __init__(self, sock, drain):
+        super().__init__(name="CAN batch receiver", daemon=True)
+        self._socket = sock
+        self._drain = drain
+        self._running = True
+
+    def run(self):
+        while self._running:
+            try:
+                readable, _, _ = select.select([self._socket], [], [], 1.0)
+                if readable:
+                    self._drain()
+            except OSError as e:
+                # e.g. interface down, keep trying
+                logging.error("CAN receive failed: %s", e)
+                time.sleep(1)
+
+    def stop(self, timeout=5):
+        self._running = False
+        self.join(timeout)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""
+Kernel CAN filters matching exactly a given set of standard frame IDs.
+IDs are merged into id/mask pairs as long as a pair covers no ID outside the set (prime implicants as in
+Quine-McCluskey), then the fewest pairs covering all IDs are picked greedily. Every frame the kernel
+drops is a wakeup of the receiving thread saved.
+
+"""
+
+CAN_SFF_MASK = 0x7FF
+
+
+def _prime_terms(ids, bits):
+    # all (value, mask) pairs matching only IDs of the set that cannot be widened further
+    terms = {(canId, CAN_SFF_MASK) for canId in ids}
+    primes = set()
+    while terms:
+        merged = set()
+        used = set()
+        for value, mask in terms:
+            for bit in range(bits):
+                b = 1 << bit
+                if mask & b and not value & b and (value | b, mask) in terms:
+                    merged.add((value, mask & ~b))
+                    used.add((value, mask))
+                    used.add((value | b, mask))
+        primes |= terms - used
+        terms = merged
+    return primes
+
+
+def can_filters(ids, bits=11):
+    """
+    python-can filters for the standard frames with the IDs given and no others,
+    extended frames are never let through.
+
+    """
+    wanted = set(ids)
+    uncovered = set(wanted)
+    terms = sorted(_prime_terms(wanted, bits))
+    matches = {
+        term: {canId for canId in wanted if canId & term[1] == term[0]}
+        for term in terms
+    }
+    filters = []
+    while uncovered:
+        value, mask = max(terms, key=lambda term: len(matches[term] & uncovered))
+        uncovered -= matches[(value, mask)]
+        filters.append({"can_id": value, "can_mask": mask, "extended": False})
+    return filters
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+Offline replay of candump log files (candump -l format, see candumps/) without socketcan,
+canplayer or a vcan interface.
+CandumpBus can be injected into UbmsBattery in place of the socketcan bus, replay() feeds the frames
+of a log straight into a listener. Both pace the frames in real time, scaled or as fast as possible.
+
+"""
+
+import logging
+import threading
+import time
+import can
+
+from argparse import ArgumentParser
+
+
+def read_candump(path):
+    # parse "(timestamp) interface ID#DATA" lines into messages, streaming the file
+    with open(path) as log:
+        for lineno, line in enumerate(log, 1):
+            try:
+                timestamp, channel, frame = line.split()
+                canId, data = frame.split("#", 1)
+            except ValueError:
+                if line.strip():
+                    logging.warning("%s:%d: malformed line skipped", path, lineno)
+                continue
+
+            if data.startswith("#"):
+                # CAN FD frames are not used by the U-BMS
+                continue
+
+            remote = data.startswith("R")
+            yield can.Message(
+                timestamp=float(timestamp[1:-1]),
+                channel=channel,
+                arbitration_id=int(canId, 16),
+                is_extended_id=len(canId) > 3,
+                is_remote_frame=remote,
+                data=None if remote else bytes.fromhex(data),
+            )
+
+
+class _Pacer:
+    # maps log timestamps onto wall clock time, speed 1 is real time, 0 or None as fast as possible
+    def __init__(self, speed):
+        self.speed = speed
+        self.origin = None
+
+    def delay(self, timestamp):
+        if not self.speed:
+            return 0
+        if self.origin is None:
+            self.origin = (timestamp, time.monotonic())
+            return 0
+        due = self.origin[1] + (timestamp - self.origin[0]) / self.speed
+        return max(0, due - time.monotonic())
+
+
+class CandumpBus(can.BusABC):
+    """
+    A read only bus replaying a candump log file, channel is the path of the log.
+    Frames sent to it (e.g. the VMU mode command) are discarded.
+
+    """
+
+    def __init__(self, channel, speed=1.0, loop=False, can_filters=None, **kwargs):
+        self.channel_info = "candump replay of %s" % channel
+        self._path = channel
+        self._loop = loop
+        self._pacer = _Pacer(speed)
+        self._frames = read_candump(channel)
+        self._pending = None
+        # added to the log timestamps, grows by the span of the log with every pass when looping
+        self._offset = 0.0
+        self._first = self._last = None
+        self._count = 0
+        self._closed = threading.Event()
+        self.finished = threading.Event()
+        super().__init__(channel, can_filters=can_filters, **kwargs)
+
+    def _next_frame(self):
+        msg = next(self._frames, None)
+        if msg is None and self._loop and self._count:
+            # restart the log, shifted so timestamps keep increasing: by its span plus the mean
+            # frame interval, the gap between the last frame of one pass and the first of the next
+            span = self._last - self._first
+            interval = span / (self._count - 1) if self._count > 1 else 1.0
+            self._offset += span + interval
+            self._frames = read_candump(self._path)
+            self._first = None
+            self._count = 0
+            msg = next(self._frames, None)
+        if msg is not None:
+            if self._first is None:
+                self._first = msg.timestamp
+            self._last = msg.timestamp
+            self._count += 1
+            msg.timestamp += self._offset
+        return msg
+
+    def _recv_internal(self, timeout):
+        if self._closed.is_set():
+            raise can.CanOperationError("Replay bus is shut down")
+
+        # filter here rather than in recv(), so frames dropped by the filters do not end a
+        # recv(timeout=0) early, like the kernel filters of socketcan
+        while self._pending is None or not self._matches_filters(self._pending):
+            self._pending = self._next_frame()
+            if self._pending is None:
+                break
+
+        if self._pending is None:
+            # end of the log, behave like an idle bus
+            self.finished.set()
+            self._closed.wait(timeout)
+            return None, False
+
+        delay = self._pacer.delay(self._pending.timestamp)
+        if delay > 0:
+            if timeout is not None and delay > timeout:
+                self._closed.wait(timeout)
+                return None, False
+            self._closed.wait(delay)
+
+        msg, self._pending = self._pending, None
+        return msg, True
+
+    def send(self, msg, timeout=None):
+        logging.debug("Replay discards sent frame %s", msg)
+
+    def shutdown(self):
+        self._closed.set()
+        super().shutdown()
+
+
+def replay(path, listener, speed=None):
+    # feed all frames of a log into the listener on the calling thread, returns the number of frames
+    pacer = _Pacer(speed)
+    count = 0
+    for msg in read_candump(path):
+        delay = pacer.delay(msg.timestamp)
+        if delay > 0:
+            time.sleep(delay)
+        listener.on_message_received(msg)
+        count += 1
+    return count
+
+
+# === All code below is to simply run it from the commandline for debugging purposes ===
+def main():
+    from ubmsbattery import UbmsBattery
+
+    parser = ArgumentParser(description="replay a candump log into the U-BMS decoder")
+    parser.add_argument("logfile", help="candump log file")
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=0,
+        help="replay speed, 1 is real time, 0 as fast as possible",
+    )
+    parser.add_argument(
+        "-c", "--capacity", type=int, default=650, help="capacity in Ah"
+    )
+    parser.add_argument(
+        "-v", "--voltage", type=float, default=29.0, help="maximum charge voltage V"
+    )
+    parser.add_argument(
+        "-d", "--debug", help="enable debug logging", action="store_true"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(levelname)-8s %(message)s",
+        level=(logging.DEBUG if args.debug else logging.INFO),
+    )
+
+    bus = CandumpBus(args.logfile, speed=args.speed)
+    start = time.monotonic()
+    bat = UbmsBattery(
+        capacity=args.capacity, voltage=args.voltage, connection="replay", bus=bus
+    )
+    bus.finished.wait()
+    elapsed = time.monotonic() - start
+
+    logging.info("Replayed %s in %.3fs", args.logfile, elapsed)
+    logging.info("SOC: %d%% U: %.2fV I: %dA", bat.soc, bat.voltage, bat.current)
+    logging.info("Max cell voltage: %1.3fV", bat.maxCellVoltage)
+    logging.info("Min cell voltage: %1.3fV", bat.minCellVoltage)
+    for i in range(bat.numberOfModules):
+        logging.info("Module %d: %s", i, bat.cells.module(i).tolist())
+
+    bat.shutdown()
+
+
+if __name__ == "__main__":
+    main()
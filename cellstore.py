@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Fixed size store of the cell voltages of all modules of a pack, updated in place by the decoder.
+Module sums are kept up to date with every cell update, highest and lowest cell are tracked
+incrementally and only rescanned when the cell holding the extreme value moves away from it.
+
+"""
+
+from array import array
+
+
+class CellStore:
+    def __init__(self, modules, cellsPerModule):
+        self.modules = modules
+        self.cellsPerModule = cellsPerModule
+        # cell voltages in mV, module by module
+        self.voltages = array("h", bytes(2 * modules * cellsPerModule))
+        # module voltages in mV
+        self.moduleSum = array("l", bytes(array("l").itemsize * modules))
+        self._maxValue = self._minValue = 0
+        self._maxIndex = self._minIndex = 0
+        self._maxStale = self._minStale = False
+
+    def __len__(self):
+        return len(self.voltages)
+
+    def set_cells(self, module, first, values):
+        # store values (mV) for the cells of module starting at cell index first
+        voltages = self.voltages
+        index = module * self.cellsPerModule + first
+        delta = 0
+        for v in values:
+            old = voltages[index]
+            if v != old:
+                voltages[index] = v
+                delta += v - old
+
+                if v >= self._maxValue:
+                    self._maxValue = v
+                    self._maxIndex = index
+                    self._maxStale = False
+                elif index == self._maxIndex:
+                    self._maxStale = True
+
+                if v <= self._minValue:
+                    self._minValue = v
+                    self._minIndex = index
+                    self._minStale = False
+                elif index == self._minIndex:
+                    self._minStale = True
+            index += 1
+        self.moduleSum[module] += delta
+
+    def _rescan(self):
+        voltages = self.voltages
+        if self._maxStale:
+            self._maxValue = max(voltages)
+            self._maxIndex = voltages.index(self._maxValue)
+            self._maxStale = False
+        if self._minStale:
+            self._minValue = min(voltages)
+            self._minIndex = voltages.index(self._minValue)
+            self._minStale = False
+
+    @property
+    def maxValue(self):
+        self._rescan()
+        return self._maxValue
+
+    @property
+    def maxIndex(self):
+        self._rescan()
+        return self._maxIndex
+
+    @property
+    def minValue(self):
+        self._rescan()
+        return self._minValue
+
+    @property
+    def minIndex(self):
+        self._rescan()
+        return self._minIndex
+
+    def module(self, module):
+        # cell voltages of one module
+        start = module * self.cellsPerModule
+        return self.voltages[start : start + self.cellsPerModule]
+
+    def cell_id(self, index):
+        # Victron style cell id, e.g. M1C4
+        module, cell = divmod(index, self.cellsPerModule)
+        return "M%dC%d" % (module + 1, cell + 1)
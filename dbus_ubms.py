@@ -11,14 +11,16 @@ import logging
 import sys
 import os
 import dbus
-import itertools
-import math
+import signal
 
-from time import time
+from time import time, monotonic, perf_counter_ns, clock_gettime, CLOCK_BOOTTIME
 from datetime import datetime
 from argparse import ArgumentParser
 
 from ubmsbattery import UbmsBattery
+from dbuspublisher import DbusPublisher
+from settingscache import SettingsCache
+from instrumentation import Histogram, RateMonitor, interface_drops
 
 
 # our own packages
@@ -30,12 +32,92 @@ from settingsdevice import SettingsDevice  # noqa: E402
 VERSION = "1.1.0"
 
 
+def process_age():
+    # seconds since this process was started, None where /proc is not available
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, which may contain spaces and parentheses
+            fields = f.read().rpartition(")")[2].split()
+        # field 22, starttime, in clock ticks after boot
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return clock_gettime(CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# interpreter startup and imports, from process start until here
+IMPORT_TIME = process_age() or 0.0
+# end of the imports, the setup of the first service (arguments, main loop, bus) counts from here
+IMPORTED = monotonic()
+
+# values with a unit, shown with the format given
+SUMMED_ITEMS = {
+    "/System/MaxCellVoltage": {"gettext": "%.2F V"},
+    "/System/MinCellVoltage": {"gettext": "%.2F V"},
+    "/Dc/0/Voltage": {"gettext": "%.2F V"},
+    "/Dc/0/Current": {"gettext": "%.1F A"},
+    "/Dc/0/Power": {"gettext": "%.0F W"},
+    "/Soc": {"gettext": "%.0F %%"},
+    "/History/TotalAhDrawn": {"gettext": "%.0F Ah"},
+    "/History/DischargedEnergy": {"gettext": "%.2F kWh"},
+    "/History/ChargedEnergy": {"gettext": "%.2F kWh"},
+    "/History/AverageDischarge": {"gettext": "%.2F kWh"},
+    "/TimeToGo": {"gettext": "%.0F s"},
+    "/ConsumedAmphours": {"gettext": "%.1F Ah"},
+}
+
+# startup phases in the order they run, each published as /Startup/<phase> in s
+STARTUP_PHASES = ("Imports", "Setup", "Discovery", "Settings", "Paths", "FirstPublish")
+
+# percentiles of the decode and update durations published under /Debug
+DEBUG_PERCENTILES = (50, 90, 99)
+
+BATTERY_CELL_DATA_FORMAT = 1
+
+
 def handle_changed_setting(setting, oldvalue, newvalue):
     logging.debug(
         "setting changed, setting: %s, old: %s, new: %s" % (setting, oldvalue, newvalue)
     )
 
 
+def localsettings(supportedSettings, eventCallback):
+    # the settings device of com.victronenergy.settings
+    return SettingsDevice(
+        bus=(
+            dbus.SystemBus()
+            if (platform.machine() == "armv7l")
+            else dbus.SessionBus()
+        ),
+        supportedSettings=supportedSettings,
+        eventCallback=eventCallback,
+    )
+
+
+def dbusconnection():
+    # a private connection per battery service, so each pack of a multi pack process registers its own '/'
+    return (
+        dbus.SessionBus(private=True)
+        if "DBUS_SESSION_BUS_ADDRESS" in os.environ
+        else dbus.SystemBus(private=True)
+    )
+
+
+class StartupTimer:
+    # durations of the startup phases in s, each lap ends one phase and starts the next
+    def __init__(self, imports, setupStart):
+        self._last = monotonic()
+        self.phases = {"Imports": imports, "Setup": self._last - setupStart}
+
+    def lap(self, phase):
+        now = monotonic()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def report(self):
+        return ", ".join("%s %.3fs" % item for item in self.phases.items())
+
+
 class DbusBatteryService:
     def __init__(
         self,
@@ -45,157 +127,81 @@ class DbusBatteryService:
         capacity,
         productname="Valence U-BMS",
         connection="can0",
+        bus=None,
+        threaded=True,
+        eventDriven=False,
+        saveInterval=600,
+        recorder=None,
+        cache=None,
+        modules=None,
+        strings=None,
+        cellsPerModule=None,
+        serviceClass=VeDbusService,
+        settingsFactory=None,
+        connectionFactory=None,
+        setupStart=IMPORTED,
     ):
         self.minUpdateDone = 0
         self.dailyResetDone = 0
-        self.lastUpdated = 0
+        # monotonic time of the first and the last complete cycle of frames
+        self.firstCycle = self.lastCycle = float("-inf")
+        self.staleModules = []
+        self.lastSlowUpdate = 0
+        self.lastVersion = -1
+        self.lastCellVoltages = None
+        self.balanced = True
+        self.updatePending = False
+        self.lastUpdateRun = 0
+        # Ah and Wh totals of the decoder at the last minute update
+        self.lastEnergy = (0.0, 0.0, 0.0, 0.0)
+        self.connection = connection
+        # duration of _update incl. the flush
+        self._updateTimes = Histogram()
+        # process start and imports are shared by all packs of the process, setup runs from the
+        # end of the imports, or for further packs from the start of their own setup, until here
+        self._startup = StartupTimer(IMPORT_TIME, setupStart)
         self._bat = UbmsBattery(
-            capacity=capacity, voltage=voltage, connection=connection
-        )
-
-        try:
-            self._dbusservice = VeDbusService(
-                servicename + ".socketcan_" + connection + "_di" + str(deviceinstance),
-                register=False
-            )
-        except:
-            exit
-
-        # Create the management objects, as specified in the ccgx dbus-api document
-        self._dbusservice.add_path("/Mgmt/ProcessName", __file__)
-        self._dbusservice.add_path(
-            "/Mgmt/ProcessVersion",
-            VERSION + " running on Python " + platform.python_version(),
-        )
-        self._dbusservice.add_path("/Mgmt/Connection", connection)
-
-        # Create the mandatory objects
-        self._dbusservice.add_path("/DeviceInstance", deviceinstance)
-        self._dbusservice.add_path("/ProductId", 0)
-        self._dbusservice.add_path("/ProductName", productname)
-        self._dbusservice.add_path("/Manufacturer", "Valence")
-        self._dbusservice.add_path("/FirmwareVersion", self._bat.firmwareVersion)
-        self._dbusservice.add_path("/HardwareVersion", "type: " + str(self._bat.bms_type) + " rev. "+ hex(self._bat.hw_rev))
-        self._dbusservice.add_path("/Connected", 0)
-        # Create battery specific objects
-        self._dbusservice.add_path("/State", 14, writeable=True)
-        self._dbusservice.add_path("/Mode", 1, writeable=True, onchangecallback=self._transmit_mode) 
-        self._dbusservice.add_path("/Soh", 100)
-        self._dbusservice.add_path("/Capacity", int(capacity))
-        self._dbusservice.add_path("/InstalledCapacity", int(capacity))
-        self._dbusservice.add_path("/Dc/0/Temperature", 25)
-        self._dbusservice.add_path("/Info/MaxChargeCurrent", 0)
-        self._dbusservice.add_path("/Info/MaxDischargeCurrent", 0)
-        self._dbusservice.add_path("/Info/MaxChargeVoltage", float(voltage))
-        self._dbusservice.add_path("/Info/BatteryLowVoltage", 44.8)
-        self._dbusservice.add_path("/Alarms/CellImbalance", 0)
-        self._dbusservice.add_path("/Alarms/LowVoltage", 0)
-        self._dbusservice.add_path("/Alarms/HighVoltage", 0)
-        self._dbusservice.add_path("/Alarms/HighDischargeCurrent", 0)
-        self._dbusservice.add_path("/Alarms/HighChargeCurrent", 0)
-        self._dbusservice.add_path("/Alarms/LowSoc", 0)
-        self._dbusservice.add_path("/Alarms/LowTemperature", 0)
-        self._dbusservice.add_path("/Alarms/HighTemperature", 0)
-        self._dbusservice.add_path("/Balancing", 0)
-        self._dbusservice.add_path("/System/HasTemperature", 1)
-        self._dbusservice.add_path("/System/NrOfBatteries", self._bat.numberOfModules)
-        self._dbusservice.add_path(
-            "/System/NrOfModulesOnline", self._bat.numberOfModules
-        )
-        self._dbusservice.add_path("/System/NrOfModulesOffline", 0)
-        self._dbusservice.add_path("/System/NrOfModulesBlockingDischarge", 0)
-        self._dbusservice.add_path("/System/NrOfModulesBlockingCharge", 0)
-        self._dbusservice.add_path("/System/NrOfBatteriesBalancing", 0)
-        self._dbusservice.add_path(
-            "/System/BatteriesParallel", self._bat.numberOfStrings
-        )
-        self._dbusservice.add_path("/System/BatteriesSeries", self._bat.modulesInSeries)
-        self._dbusservice.add_path(
-            "/System/NrOfCellsPerBattery", self._bat.cellsPerModule
-        )
-        self._dbusservice.add_path("/System/MinVoltageCellId", "M_C_")
-        self._dbusservice.add_path("/System/MaxVoltageCellId", "M_C_")
-        self._dbusservice.add_path("/System/MinCellTemperature", 10.0)
-        self._dbusservice.add_path("/System/MaxCellTemperature", 10.0)
-        self._dbusservice.add_path("/System/MaxPcbTemperature", 10.0)
-
-        BATTERY_CELL_DATA_FORMAT = 1
-
-        if BATTERY_CELL_DATA_FORMAT > 0:
-            for i in range(1, self._bat.cellsPerModule * self._bat.numberOfModules + 1):
-                cellpath = (
-                    "/Cell/%s/Volts"
-                    if (BATTERY_CELL_DATA_FORMAT & 2)
-                    else "/Voltages/Cell%s"
-                )
-                self._dbusservice.add_path(
-                    cellpath % (str(i)),
-                    None,
-                    writeable=True,
-                    gettextcallback=lambda p, v: "{:0.3f}V".format(v),
-                )
-                if BATTERY_CELL_DATA_FORMAT & 1:
-                    self._dbusservice.add_path(
-                        "/Balances/Cell%s" % (str(i)), None, writeable=True
-                    )
-            pathbase = "Cell" if (BATTERY_CELL_DATA_FORMAT & 2) else "Voltages"
-            self._dbusservice.add_path(
-                "/%s/Sum" % pathbase,
-                None,
-                writeable=True,
-                gettextcallback=lambda p, v: "{:2.2f}V".format(v),
-            )
-            self._dbusservice.add_path(
-                "/%s/Diff" % pathbase,
-                None,
-                writeable=True,
-                gettextcallback=lambda p, v: "{:0.3f}V".format(v),
-            )
-
-        self._settings = SettingsDevice(
-            bus=(
-                dbus.SystemBus()
-                if (platform.machine() == "armv7l")
-                else dbus.SessionBus()
-            ),
-            supportedSettings={
-                "AvgDischarge": ["/Settings/Ubms/AvgerageDischarge", 0.0, 0, 0],
-                "TotalAhDrawn": ["/Settings/Ubms/TotalAhDrawn", 0.0, 0, 0],
-                "TimeLastFull": ["/Settings/Ubms/TimeLastFull", 0.0, 0, 0],
-                "MinCellVoltage": ["/Settings/Ubms/MinCellVoltage", 4.0, 2.0, 4.2],
-                "MaxCellVoltage": ["/Settings/Ubms/MaxCellVoltage", 2.0, 2.0, 4.2],
-                "interval": ["/Settings/Ubms/Interval", 50, 50, 200],
-            },
-            eventCallback=handle_changed_setting,
+            capacity=capacity,
+            voltage=voltage,
+            connection=connection,
+            bus=bus,
+            threaded=threaded,
+            recorder=recorder,
+            cache=cache,
+            modules=modules,
+            strings=strings,
+            cellsPerModule=cellsPerModule,
         )
 
-        self._summeditems = {
-            "/System/MaxCellVoltage": {"gettext": "%.2F V"},
-            "/System/MinCellVoltage": {"gettext": "%.2F V"},
-            "/Dc/0/Voltage": {"gettext": "%.2F V"},
-            "/Dc/0/Current": {"gettext": "%.1F A"},
-            "/Dc/0/Power": {"gettext": "%.0F W"},
-            "/Soc": {"gettext": "%.0F %%"},
-            "/History/TotalAhDrawn": {"gettext": "%.0F Ah"},
-            "/History/DischargedEnergy": {"gettext": "%.2F kWh"},
-            "/History/ChargedEnergy": {"gettext": "%.2F kWh"},
-            "/History/AverageDischarge": {"gettext": "%.2F kWh"},
-            "/TimeToGo": {"gettext": "%.0F s"},
-            "/ConsumedAmphours": {"gettext": "%.1F Ah"},
+        self._startup.lap("Discovery")
+        self._rates = RateMonitor(self._bat.stats)
+
+        # the first pack keeps the original settings paths, further packs of a multi pack
+        # process get their own branch
+        base = "/Settings/Ubms"
+        if deviceinstance != 0:
+            base += "/%d" % deviceinstance
+
+        supportedSettings = {
+            "AvgDischarge": [base + "/AvgerageDischarge", 0.0, 0, 0],
+            "TotalAhDrawn": [base + "/TotalAhDrawn", 0.0, 0, 0],
+            "TimeLastFull": [base + "/TimeLastFull", 0.0, 0, 0],
+            "MinCellVoltage": [base + "/MinCellVoltage", 4.0, 2.0, 4.2],
+            "MaxCellVoltage": [base + "/MaxCellVoltage", 2.0, 2.0, 4.2],
+            "interval": [base + "/Interval", 50, 50, 200],
         }
-        for path in self._summeditems.keys():
-            self._dbusservice.add_path(path, value=None, gettextcallback=self._gettext)
-
-        self._dbusservice["/History/AverageDischarge"] = self._settings["AvgDischarge"]
-        self._dbusservice["/History/TotalAhDrawn"] = self._settings["TotalAhDrawn"]
-        self._dbusservice.add_path("/History/TimeSinceLastFullCharge", 0)
-        self._dbusservice.add_path(
-            "/History/MinCellVoltage", self._settings["MinCellVoltage"]
+        settings = (settingsFactory or localsettings)(
+            supportedSettings, self._setting_changed
         )
-        self._dbusservice.add_path(
-            "/History/MaxCellVoltage", self._settings["MaxCellVoltage"]
+        # all reads are served locally, the history is written to flash every saveInterval seconds
+        # and only if it changed noticeably
+        self._settings = SettingsCache(
+            settings,
+            supportedSettings,
+            thresholds={"AvgDischarge": 0.01, "TotalAhDrawn": 1.0},
         )
-        self._dbusservice["/ConsumedAmphours"] = 0
+        GLib.timeout_add_seconds(saveInterval, exit_on_error, self._save_settings)
+        self._startup.lap("Settings")
 
         logging.info(
             "History cell voltage min: %.3f, max: %.3f, totalAhDrawn: %d",
@@ -204,14 +210,197 @@ class DbusBatteryService:
             self._settings["TotalAhDrawn"],
         )
 
-        self._dbusservice["/History/ChargedEnergy"] = 0
-        self._dbusservice["/History/DischargedEnergy"] = 0
+        try:
+            self._dbusservice = serviceClass(
+                servicename + ".socketcan_" + connection + "_di" + str(deviceinstance),
+                bus=(connectionFactory or dbusconnection)(),
+                register=False,
+            )
+        except:
+            exit
 
+        # all paths are added before the service is registered, so none of them is announced on its own
+        for path, value, options in self._paths(
+            productname, connection, deviceinstance, capacity, voltage
+        ):
+            self._dbusservice.add_path(path, value, **options)
         self._dbusservice.register()
-        GLib.timeout_add(self._settings["interval"], exit_on_error, self._update)
+        self._startup.lap("Paths")
+        self._publisher = DbusPublisher(self._dbusservice)
+        for phase, duration in self._startup.phases.items():
+            self._publisher["/Startup/" + phase] = duration
+        if eventDriven:
+            # publish when the decoder completes a cycle, at most once per interval,
+            # plus a slow watchdog tick for the connection state and the 20s values of an idle bus
+            self._bat.onSnapshot = self._schedule_update
+            GLib.timeout_add_seconds(10, exit_on_error, self._update)
+        else:
+            GLib.timeout_add(self._settings["interval"], exit_on_error, self._update)
+
+    def _paths(self, productname, connection, deviceinstance, capacity, voltage):
+        # all paths of the service as (path, initial value, add_path options)
+        bat = self._bat
+        paths = [
+            # the management objects, as specified in the ccgx dbus-api document
+            ("/Mgmt/ProcessName", __file__, {}),
+            (
+                "/Mgmt/ProcessVersion",
+                VERSION + " running on Python " + platform.python_version(),
+                {},
+            ),
+            ("/Mgmt/Connection", connection, {}),
+            # the mandatory objects
+            ("/DeviceInstance", deviceinstance, {}),
+            ("/ProductId", 0, {}),
+            ("/ProductName", productname, {}),
+            ("/Manufacturer", "Valence", {}),
+            ("/FirmwareVersion", bat.firmwareVersion, {}),
+            (
+                "/HardwareVersion",
+                "type: " + str(bat.bms_type) + " rev. " + hex(bat.hw_rev),
+                {},
+            ),
+            ("/Connected", 0, {}),
+            # battery specific objects
+            ("/State", 14, {"writeable": True}),
+            (
+                "/Mode",
+                1,
+                {"writeable": True, "onchangecallback": self._transmit_mode},
+            ),
+            ("/Soh", 100, {}),
+            ("/Capacity", int(capacity), {}),
+            ("/InstalledCapacity", int(capacity), {}),
+            ("/Dc/0/Temperature", 25, {}),
+            ("/Info/MaxChargeCurrent", 0, {}),
+            ("/Info/MaxDischargeCurrent", 0, {}),
+            ("/Info/MaxChargeVoltage", float(voltage), {}),
+            ("/Info/BatteryLowVoltage", 44.8, {}),
+            ("/Alarms/CellImbalance", 0, {}),
+            ("/Alarms/LowVoltage", 0, {}),
+            ("/Alarms/HighVoltage", 0, {}),
+            ("/Alarms/HighDischargeCurrent", 0, {}),
+            ("/Alarms/HighChargeCurrent", 0, {}),
+            ("/Alarms/LowSoc", 0, {}),
+            ("/Alarms/LowTemperature", 0, {}),
+            ("/Alarms/HighTemperature", 0, {}),
+            ("/Balancing", 0, {}),
+            ("/System/HasTemperature", 1, {}),
+            ("/System/NrOfBatteries", bat.numberOfModules, {}),
+            ("/System/NrOfModulesOnline", bat.numberOfModules, {}),
+            ("/System/NrOfModulesOffline", 0, {}),
+            ("/System/NrOfModulesBlockingDischarge", 0, {}),
+            ("/System/NrOfModulesBlockingCharge", 0, {}),
+            ("/System/NrOfBatteriesBalancing", 0, {}),
+            ("/System/BatteriesParallel", bat.numberOfStrings, {}),
+            ("/System/BatteriesSeries", bat.modulesInSeries, {}),
+            ("/System/NrOfCellsPerBattery", bat.cellsPerModule, {}),
+            ("/System/MinVoltageCellId", "M_C_", {}),
+            ("/System/MaxVoltageCellId", "M_C_", {}),
+            ("/System/MinCellTemperature", 10.0, {}),
+            ("/System/MaxCellTemperature", 10.0, {}),
+            ("/System/MaxPcbTemperature", 10.0, {}),
+        ]
+
+        # cell paths are resolved once, _update_slow publishes them by index from the cell store
+        self._cellVoltagePaths = ()
+        self._cellBalancePaths = ()
+        if BATTERY_CELL_DATA_FORMAT > 0:
+            cells = range(1, bat.cellsPerModule * bat.numberOfModules + 1)
+            cellpath = (
+                "/Cell/%d/Volts" if (BATTERY_CELL_DATA_FORMAT & 2) else "/Voltages/Cell%d"
+            )
+            self._cellVoltagePaths = tuple(cellpath % i for i in cells)
+            volts = {
+                "writeable": True,
+                "gettextcallback": lambda p, v: "{:0.3f}V".format(v),
+            }
+            paths += [(path, None, volts) for path in self._cellVoltagePaths]
+            if BATTERY_CELL_DATA_FORMAT & 1:
+                self._cellBalancePaths = tuple("/Balances/Cell%d" % i for i in cells)
+                paths += [
+                    (path, None, {"writeable": True}) for path in self._cellBalancePaths
+                ]
+            pathbase = "Cell" if (BATTERY_CELL_DATA_FORMAT & 2) else "Voltages"
+            paths += [
+                (
+                    "/%s/Sum" % pathbase,
+                    None,
+                    {
+                        "writeable": True,
+                        "gettextcallback": lambda p, v: "{:2.2f}V".format(v),
+                    },
+                ),
+                ("/%s/Diff" % pathbase, None, volts),
+            ]
+
+        initial = {
+            "/History/AverageDischarge": self._settings["AvgDischarge"],
+            "/History/TotalAhDrawn": self._settings["TotalAhDrawn"],
+            "/History/ChargedEnergy": 0,
+            "/History/DischargedEnergy": 0,
+            "/ConsumedAmphours": 0,
+        }
+        paths += [
+            (path, initial.get(path), {"gettextcallback": self._gettext})
+            for path in SUMMED_ITEMS
+        ]
+        paths += [
+            ("/History/TimeSinceLastFullCharge", 0, {}),
+            ("/History/MinCellVoltage", self._settings["MinCellVoltage"], {}),
+            ("/History/MaxCellVoltage", self._settings["MaxCellVoltage"], {}),
+        ]
+        paths += [
+            ("/Startup/" + phase, None, {"gettextcallback": lambda p, v: "%.3fs" % v})
+            for phase in STARTUP_PHASES
+        ]
+
+        # hot path counters, see _update_debug
+        self._debugFramePaths = tuple(
+            "/Debug/Frames/0x%03X" % canId for canId in bat.stats.ids
+        )
+        paths += [(path, 0, {}) for path in self._debugFramePaths]
+        self._debugRatePaths = tuple(
+            "/Debug/Rates/0x%03X" % canId for canId in bat.stats.ids
+        )
+        paths += [(path, 0.0, {}) for path in self._debugRatePaths]
+        paths += [
+            ("/Debug/Frames/Total", 0, {}),
+            ("/Debug/Frames/Unknown", 0, {}),
+            ("/Debug/Receive/Batch", 0, {}),
+            ("/Debug/Receive/MaxBatch", 0, {}),
+            ("/Debug/Receive/Dropped", None, {}),
+            ("/Debug/Bus/FramesPerSecond", 0.0, {}),
+            ("/Debug/Bus/Load", 0.0, {"gettextcallback": lambda p, v: "%.1f%%" % v}),
+            ("/Debug/Modules/Stale", 0, {}),
+        ]
+        for name, unit in (("Decode", "us"), ("Update", "ms")):
+            fmt = {"gettextcallback": lambda p, v, unit=unit: "%.1f%s" % (v, unit)}
+            paths += [
+                ("/Debug/%s/P%d" % (name, p), None, fmt) for p in DEBUG_PERCENTILES
+            ]
+            paths.append(("/Debug/%s/Max" % name, None, fmt))
+        return paths
+
+    def _schedule_update(self):
+        # called from the CAN thread for each new snapshot, coalesces them into one pending update
+        if self.updatePending:
+            return
+        self.updatePending = True
+        due = self.lastUpdateRun + self._settings["interval"] / 1000.0
+        GLib.timeout_add(
+            max(0, int((due - monotonic()) * 1000)), self._scheduled_update
+        )
+
+    def _scheduled_update(self):
+        # clear first, a snapshot arriving during the update schedules the next one
+        self.updatePending = False
+        self.lastUpdateRun = monotonic()
+        exit_on_error(self._update)
+        return False
 
     def _gettext(self, path, value):
-        item = self._summeditems.get(path)
+        item = SUMMED_ITEMS.get(path)
         if item is not None:
             return item["gettext"] % value
         return str(value)
@@ -227,122 +416,196 @@ class DbusBatteryService:
         self._safe_history()
         logging.info("Stopping dbus_ubms")
 
+    def _setting_changed(self, setting, oldvalue, newvalue):
+        handle_changed_setting(setting, oldvalue, newvalue)
+        self._settings.changed(setting, oldvalue, newvalue)
+
+    def _save_settings(self):
+        self._settings.flush()
+        return True
+
+    def history(self, metric, module, cell=None, start=0, end=float("inf"), step=None):
+        # recorded values of the battery, see UbmsBattery.history
+        return self._bat.history(metric, module, cell, start, end, step)
+
+    def shutdown(self):
+        # persist the history collected since the last save and stop receiving
+        self._safe_history()
+        self._settings.flush()
+        self._bat.shutdown()
+
     def _safe_history(self):
         logging.debug("Saving history to localsettings")
-        self._settings["AvgDischarge"] = self._dbusservice["/History/AverageDischarge"]
-        self._settings["TotalAhDrawn"] = self._dbusservice["/History/TotalAhDrawn"]
-        self._settings["MinCellVoltage"] = self._dbusservice["/History/MinCellVoltage"]
+        self._settings["AvgDischarge"] = self._publisher["/History/AverageDischarge"]
+        self._settings["TotalAhDrawn"] = self._publisher["/History/TotalAhDrawn"]
+        self._settings["MinCellVoltage"] = self._publisher["/History/MinCellVoltage"]
         # self._settings['MaxCellVoltage'] = self._dbusservice['/History/MaxCellVoltage']
 
-    def _daily_stats(self):
-        if self._dbusservice["/History/DischargedEnergy"] == 0:
+    def _daily_stats(self, snap):
+        if self._publisher["/History/DischargedEnergy"] == 0:
             return
         logging.info(
             "Updating stats, SOC: %d, Discharged: %.2f, Charged: %.2f ",
-            self._bat.soc,
-            self._dbusservice["/History/DischargedEnergy"],
-            self._dbusservice["/History/ChargedEnergy"],
+            snap.soc,
+            self._publisher["/History/DischargedEnergy"],
+            self._publisher["/History/ChargedEnergy"],
         )
-        self._dbusservice["/History/AverageDischarge"] = (
-            6 * self._dbusservice["/History/AverageDischarge"]
-            + self._dbusservice["/History/DischargedEnergy"]
+        self._publisher["/History/AverageDischarge"] = (
+            6 * self._publisher["/History/AverageDischarge"]
+            + self._publisher["/History/DischargedEnergy"]
         ) / 7  # rolling week
-        self._dbusservice["/History/ChargedEnergy"] = 0
-        self._dbusservice["/History/DischargedEnergy"] = 0
+        self._publisher["/History/ChargedEnergy"] = 0
+        self._publisher["/History/DischargedEnergy"] = 0
         dt = datetime.now() - datetime.fromtimestamp(
             float(self._settings["TimeLastFull"])
         )
       
         # estimate SOH by BMS calculated SOC difference to 100% vs consumed amphours to full capacity
         # only do this if the last full charge was less than 24h ago and SOC < 70%
-        if dt.total_seconds() < 24 * 3600 and self._bat.soc < 70:
+        if dt.total_seconds() < 24 * 3600 and snap.soc < 70:
          
-            self._dbusservice["/Soh"] = int(
-                -self._dbusservice["/ConsumedAmphours"] / (100 - self._bat.soc)
-                * self._dbusservice["/InstalledCapacity"]
+            self._publisher["/Soh"] = int(
+                -self._publisher["/ConsumedAmphours"] / (100 - snap.soc)
+                * self._publisher["/InstalledCapacity"]
             )
             logging.info(
                 "SOH: %d, Capacity: %d ",
-                self._dbusservice["/Soh"],
-                self._dbusservice["/Capacity"],
+                self._publisher["/Soh"],
+                self._publisher["/Capacity"],
             )
         self.dailyResetDone = datetime.now().day
 
     def _update(self):
-        if (self._bat.updated != -1 and self.lastUpdated == 0) or (
-            (self._bat.updated - self.lastUpdated) < 10
+        begin = perf_counter_ns()
+        # read the decoder state once, it is replaced as a whole by the CAN thread
+        snap = self._bat.snapshot
+
+        if self._bat.verified is False:
+            # warm started with a stale identity, the restart verifies the BMS on the bus
+            raise RuntimeError("U-BMS differs from the cached identity, restarting")
+
+        # nothing new decoded since the last tick
+        now = monotonic()
+        if snap.version != self.lastVersion:
+            self.lastVersion = snap.version
+            if self.lastCycle == float("-inf"):
+                self.firstCycle = now
+            self.lastCycle = now
+            self._bat.record_history(snap)
+            self._update_fast(snap)
+
+        # connected as long as the BMS completes cycles, whatever else is on the bus
+        self._publisher["/Connected"] = 1 if now - self.lastCycle < 10 else 0
+
+        # only update the below every 20s to reduce load
+        if now - self.lastSlowUpdate >= 20:
+            self.lastSlowUpdate = now
+            self._update_slow(snap)
+
+        if "FirstPublish" not in self._startup.phases:
+            self._startup.lap("FirstPublish")
+            self._publisher["/Startup/FirstPublish"] = self._startup.phases["FirstPublish"]
+            logging.info("Startup: %s", self._startup.report())
+
+        # publish everything that changed in this cycle at once
+        self._publisher.flush()
+        self._updateTimes.add(perf_counter_ns() - begin)
+        return True
+
+    def _update_debug(self):
+        # counters of the hot paths, decode times per frame in us, update times in ms
+        stats = self._bat.stats
+        self._publisher.set_many(
+            self._debugFramePaths, [stats.frames[canId] for canId in stats.ids]
+        )
+        self._publisher["/Debug/Frames/Total"] = stats.total
+        self._publisher["/Debug/Frames/Unknown"] = stats.unknown
+        self._publisher["/Debug/Receive/Batch"] = stats.lastBatch
+        self._publisher["/Debug/Receive/MaxBatch"] = stats.maxBatch
+        self._publisher["/Debug/Receive/Dropped"] = interface_drops(self.connection)
+        # frames per s and bus load since the last call
+        rates = self._rates
+        rates.update()
+        self._publisher.set_many(
+            self._debugRatePaths, [round(rate, 2) for rate in rates.rates]
+        )
+        self._publisher["/Debug/Bus/FramesPerSecond"] = round(rates.framesPerSecond, 1)
+        self._publisher["/Debug/Bus/Load"] = round(rates.load * 100, 1)
+        self._publisher["/Debug/Modules/Stale"] = len(self.staleModules)
+        for name, histogram, scale in (
+            ("Decode", stats.decode, 1e-3),
+            ("Update", self._updateTimes, 1e-6),
         ):
-            self.lastUpdated = self._bat.updated
-            self._dbusservice["/Connected"] = 1
-        else:
-            self._dbusservice["/Connected"] = 0
+            for p in DEBUG_PERCENTILES:
+                value = histogram.percentile(p)
+                self._publisher["/Debug/%s/P%d" % (name, p)] = (
+                    None if value is None else value * scale
+                )
+            self._publisher["/Debug/%s/Max" % name] = histogram.max * scale
 
-        #       self._dbusservice['/Alarms/CellImbalance'] = (self._bat.internalErrors & 0x20)>>5
-        deltaCellVoltage = self._bat.maxCellVoltage - self._bat.minCellVoltage
+    def _update_fast(self, snap):
+        #       self._publisher['/Alarms/CellImbalance'] = (self._bat.internalErrors & 0x20)>>5
+        deltaCellVoltage = snap.maxCellVoltage - snap.minCellVoltage
 
         # flag cell imbalance, only log first occurence
         if deltaCellVoltage > 0.25:
-            self._dbusservice["/Alarms/CellImbalance"] = 2
-            if self._bat.balanced:
+            self._publisher["/Alarms/CellImbalance"] = 2
+            if self.balanced:
                 #                       logging.error("Cell voltage imbalance: %.2fV, SOC: %d, @Module: %d ", deltaCellVoltage, self._bat.soc, self._bat.moduleSoc.index(min(self.moduleSoc)))
                 logging.error(
                     "Cell voltage imbalance: %.2fV, SOC: %d ",
                     deltaCellVoltage,
-                    self._bat.soc,
+                    snap.soc,
                 )
-                logging.info("SOC: %d ", self._bat.soc)
-            self._bat.balanced = False
+                logging.info("SOC: %d ", snap.soc)
+            self.balanced = False
         elif deltaCellVoltage >= 0.18:
             # warn only if not already balancing (UBMS threshold is 0.15V)
-            if self._bat.numberOfModulesBalancing == 0:
-                self._dbusservice["/Alarms/CellImbalance"] = 1
-            if self._bat.balanced:
-                chain = itertools.chain(*self._bat.cellVoltages)
-                flatVList = list(chain)
-                iMax = flatVList.index(max(flatVList))
-                iMin = flatVList.index(min(flatVList))
+            if snap.numberOfModulesBalancing == 0:
+                self._publisher["/Alarms/CellImbalance"] = 1
+            if self.balanced:
                 logging.info(
                     "Cell voltage imbalance: %.2fV, iMin: %d, iMax %d, SOC: %d ",
                     deltaCellVoltage,
-                    iMin,
-                    iMax,
-                    self._bat.soc,
+                    snap.minCellIndex,
+                    snap.maxCellIndex,
+                    snap.soc,
                 )
-            self._bat.balanced = False
+            self.balanced = False
         else:
-            self._dbusservice["/Alarms/CellImbalance"] = 0
-            self._bat.balanced = True
+            self._publisher["/Alarms/CellImbalance"] = 0
+            self.balanced = True
 
-        self._dbusservice["/Alarms/LowVoltage"] = (
-            self._bat.voltageAndCellTAlarms & 0x10
+        self._publisher["/Alarms/LowVoltage"] = (
+            snap.voltageAndCellTAlarms & 0x10
         ) >> 3
-        self._dbusservice["/Alarms/HighVoltage"] = (
-            self._bat.voltageAndCellTAlarms & 0x20
+        self._publisher["/Alarms/HighVoltage"] = (
+            snap.voltageAndCellTAlarms & 0x20
         ) >> 4
-        self._dbusservice["/Alarms/LowSoc"] = (
-            self._bat.voltageAndCellTAlarms & 0x08
+        self._publisher["/Alarms/LowSoc"] = (
+            snap.voltageAndCellTAlarms & 0x08
         ) >> 3
-        self._dbusservice["/Alarms/HighDischargeCurrent"] = (
-            self._bat.currentAndPcbTAlarms & 0x3
+        self._publisher["/Alarms/HighDischargeCurrent"] = (
+            snap.currentAndPcbTAlarms & 0x3
         )
 
         #       flag high cell temperature alarm and high pcb temperature alarm
-        self._dbusservice["/Alarms/HighTemperature"] = (
-            self._bat.voltageAndCellTAlarms & 0x6
-        ) >> 1 | (self._bat.currentAndPcbTAlarms & 0x18) >> 3
-        self._dbusservice["/Alarms/LowTemperature"] = (self._bat.mode & 0x60) >> 5
+        self._publisher["/Alarms/HighTemperature"] = (
+            snap.voltageAndCellTAlarms & 0x6
+        ) >> 1 | (snap.currentAndPcbTAlarms & 0x18) >> 3
+        self._publisher["/Alarms/LowTemperature"] = (snap.mode & 0x60) >> 5
 
-        self._dbusservice["/Soc"] = self._bat.soc
+        self._publisher["/Soc"] = snap.soc
         dt = datetime.now() - datetime.fromtimestamp(
             float(self._settings["TimeLastFull"])
         )
-        self._dbusservice["/History/TimeSinceLastFullCharge"] = (
+        self._publisher["/History/TimeSinceLastFullCharge"] = (
             dt.seconds + dt.days * 24 * 3600
         )
 
-        if self._bat.soc == 100 or self._bat.chargeComplete:
+        if snap.soc == 100 or snap.chargeComplete:
             # reset used Amphours to zero
-            self._dbusservice["/ConsumedAmphours"] = 0
+            self._publisher["/ConsumedAmphours"] = 0
             if (
                 datetime.fromtimestamp(time()).day
                 != datetime.fromtimestamp(float(self._settings["TimeLastFull"])).day
@@ -350,90 +613,78 @@ class DbusBatteryService:
                 # and if it is the first time that day also create log entry
                 logging.info(
                     "Fully charged, Discharged: %.2f, Charged: %.2f ",
-                    self._dbusservice["/History/DischargedEnergy"],
-                    self._dbusservice["/History/ChargedEnergy"],
+                    self._publisher["/History/DischargedEnergy"],
+                    self._publisher["/History/ChargedEnergy"],
                 )
                 self._settings["TimeLastFull"] = time()
 
-        self._dbusservice["/State"] = self._bat.state
-        #self._dbusservice["/Mode"] = self._bat.guiModeKey.get(
+        self._publisher["/State"] = snap.state
+        #self._publisher["/Mode"] = self._bat.guiModeKey.get(
         #    (self._bat.mode & 0x3), 252
         #)
-        self._dbusservice["/Balancing"] = (self._bat.mode & 0x10) >> 4
-        self._dbusservice["/Dc/0/Current"] = self._bat.current
-        self._dbusservice["/Dc/0/Voltage"] = self._bat.voltage
-        power = self._bat.voltage * self._bat.current
-        self._dbusservice["/Dc/0/Power"] = power
-        self._dbusservice["/Dc/0/Temperature"] = self._bat.maxCellTemperature
-
-        # only update the below every 20s to reduce load
-        if datetime.now().second not in [0, 20, 40]:
-            return True
-
+        self._publisher["/Balancing"] = (snap.mode & 0x10) >> 4
+        self._publisher["/Dc/0/Current"] = snap.current
+        self._publisher["/Dc/0/Voltage"] = snap.voltage
+        power = snap.voltage * snap.current
+        self._publisher["/Dc/0/Power"] = power
+        self._publisher["/Dc/0/Temperature"] = snap.maxCellTemperature
+
+    def _update_slow(self, snap):
         # estimate available capacity from SOC and installed capacity
-        self._dbusservice["/Capacity"] = int(
-                self._dbusservice["/InstalledCapacity"]
-                * self._bat.soc * 0.01
-        )
-
-        chain = itertools.chain(*self._bat.cellVoltages)
-        flatVList = list(chain)
-
-        index = flatVList.index(max(flatVList))
-        m = math.floor(index / 4)
-        c = index % 4
-        self._dbusservice["/System/MaxVoltageCellId"] = (
-            "M" + str(m + 1) + "C" + str(c + 1)
+        self._publisher["/Capacity"] = int(
+                self._publisher["/InstalledCapacity"]
+                * snap.soc * 0.01
         )
-        self._dbusservice["/System/MaxCellVoltage"] = self._bat.maxCellVoltage
 
-        index = flatVList.index(min(flatVList))
-        m = math.floor(index / 4)
-        c = index % 4
-        self._dbusservice["/System/MinVoltageCellId"] = (
-            "M" + str(m + 1) + "C" + str(c + 1)
-        )
-        self._dbusservice["/System/MinCellVoltage"] = self._bat.minCellVoltage
-
-        # cell voltages
-        try:
-            voltageSum = 0
-            for i in range(len(flatVList)):
-                voltage = flatVList[i] / 1000.0
-                cellpath = "/Voltages/Cell%s"
-                self._dbusservice[cellpath % (str(i + 1))] = voltage
-                self._dbusservice["/Balances/Cell%s" % (str(i + 1))] = voltage
-                if voltage and i < self._bat.cellsPerModule * self._bat.modulesInSeries:
-                    voltageSum += voltage
-            self._dbusservice["/Voltages/Sum"] = voltageSum
-            self._dbusservice["/Voltages/Diff"] = (
-                self._bat.maxCellVoltage - self._bat.minCellVoltage
+        cells = self._bat.cells
+        self._publisher["/System/MaxVoltageCellId"] = cells.cell_id(snap.maxCellIndex)
+        self._publisher["/System/MaxCellVoltage"] = snap.maxCellVoltage
+        self._publisher["/System/MinVoltageCellId"] = cells.cell_id(snap.minCellIndex)
+        self._publisher["/System/MinCellVoltage"] = snap.minCellVoltage
+
+        # cell voltages, converted and published only if any cell changed since the last run
+        if snap.cellVoltages != self.lastCellVoltages:
+            self.lastCellVoltages = snap.cellVoltages
+            voltages = [voltage / 1000.0 for voltage in snap.cellVoltages]
+            self._publisher.set_many(self._cellVoltagePaths, voltages)
+            self._publisher.set_many(self._cellBalancePaths, voltages)
+        # the first modulesInSeries modules make up one string
+        voltageSum = sum(snap.moduleVoltage[0 : self._bat.modulesInSeries]) / 1000.0
+        self._publisher["/Voltages/Sum"] = voltageSum
+        self._publisher["/Voltages/Diff"] = snap.maxCellVoltage - snap.minCellVoltage
+
+        if snap.maxCellVoltage > self._publisher["/History/MaxCellVoltage"]:
+            self._publisher["/History/MaxCellVoltage"] = snap.maxCellVoltage
+            logging.debug("New maximum cell voltage: %f", snap.maxCellVoltage)
+
+        if 0 < snap.minCellVoltage < self._publisher["/History/MinCellVoltage"]:
+            self._publisher["/History/MinCellVoltage"] = snap.minCellVoltage
+            logging.debug("New minimum cell voltage: %f", snap.minCellVoltage)
+        self._publisher["/System/MinCellTemperature"] = snap.minCellTemperature
+        self._publisher["/System/MaxCellTemperature"] = snap.maxCellTemperature
+        self._publisher["/System/MaxPcbTemperature"] = snap.maxPcbTemperature
+        self._publisher["/Info/MaxChargeCurrent"] = snap.maxChargeCurrent
+        self._publisher["/Info/MaxDischargeCurrent"] = snap.maxDischargeCurrent
+        self._publisher["/Info/MaxChargeVoltage"] = snap.maxChargeVoltage
+        # modules the BMS misses or whose frames stopped arriving, once all had time to send
+        stale = []
+        if monotonic() - self.firstCycle >= 10:
+            stale = self._bat.stale_modules()
+        if stale != self.staleModules:
+            logging.warning(
+                "Modules without recent frames: %s",
+                ", ".join(str(m + 1) for m in stale) or "none",
             )
-        except Exception:
-            pass
-
-        if self._bat.maxCellVoltage > self._dbusservice["/History/MaxCellVoltage"]:
-            self._dbusservice["/History/MaxCellVoltage"] = self._bat.maxCellVoltage
-            logging.debug("New maximum cell voltage: %f", self._bat.maxCellVoltage)
-
-        if 0 < self._bat.minCellVoltage < self._dbusservice["/History/MinCellVoltage"]:
-            self._dbusservice["/History/MinCellVoltage"] = self._bat.minCellVoltage
-            logging.debug("New minimum cell voltage: %f", self._bat.minCellVoltage)
-        self._dbusservice["/System/MinCellTemperature"] = self._bat.minCellTemperature
-        self._dbusservice["/System/MaxCellTemperature"] = self._bat.maxCellTemperature
-        self._dbusservice["/System/MaxPcbTemperature"] = self._bat.maxPcbTemperature
-        self._dbusservice["/Info/MaxChargeCurrent"] = self._bat.maxChargeCurrent
-        self._dbusservice["/Info/MaxDischargeCurrent"] = self._bat.maxDischargeCurrent
-        self._dbusservice["/Info/MaxChargeVoltage"] = self._bat.maxChargeVoltage
-        self._dbusservice["/System/NrOfModulesOnline"] = (
-            self._bat.numberOfModulesCommunicating
-        )
-        self._dbusservice["/System/NrOfModulesOffline"] = (
-            self._bat.numberOfModules - self._bat.numberOfModulesCommunicating
+            self.staleModules = stale
+        offline = max(
+            snap.numberOfModules - snap.numberOfModulesCommunicating, len(stale)
         )
-        self._dbusservice["/System/NrOfBatteriesBalancing"] = (
-            self._bat.numberOfModulesBalancing
+        self._publisher["/System/NrOfModulesOnline"] = snap.numberOfModules - offline
+        self._publisher["/System/NrOfModulesOffline"] = offline
+        self._publisher["/System/NrOfBatteriesBalancing"] = (
+            snap.numberOfModulesBalancing
         )
+        self._update_debug()
 
         # update energy statistics daily at 6:00,
         if (
@@ -441,55 +692,59 @@ class DbusBatteryService:
             and datetime.now().minute == 0
             and datetime.now().day != self.dailyResetDone
         ):
-            self._daily_stats()
+            self._daily_stats(snap)
 
         now = datetime.now().time()
         if now.minute != self.minUpdateDone:
             self.minUpdateDone = now.minute
-            if self._bat.current > 0:
-                # charging
-                self._dbusservice["/History/ChargedEnergy"] += (
-                    power * 1.666667e-5
-                )  # kWh
-                # calculate time to full, in the absense of a mutex accessing bat.current value might have changed
-                # to 0 after check above, so try to catch a div0
-                try:
-                    self._dbusservice["/TimeToGo"] = (
-                        (100 - self._bat.soc)
-                        * self._bat.capacity
-                        * 36
-                        / self._bat.current
-                    )
-                except:
-                    self._dbusservice["/TimeToGo"] = (
-                        self._bat.soc * self._bat.capacity * 36
-                    )
+            # add what the decoder integrated since the last minute
+            totals = (
+                snap.chargedAh,
+                snap.dischargedAh,
+                snap.chargedWh,
+                snap.dischargedWh,
+            )
+            chargedAh, dischargedAh, chargedWh, dischargedWh = (
+                total - last for total, last in zip(totals, self.lastEnergy)
+            )
+            self.lastEnergy = totals
+            self._publisher["/History/ChargedEnergy"] += chargedWh * 0.001  # kWh
+            self._publisher["/History/DischargedEnergy"] += dischargedWh * 0.001  # kWh
+            self._publisher["/ConsumedAmphours"] -= dischargedAh  # Ah
+            self._publisher["/History/TotalAhDrawn"] -= dischargedAh  # Ah
+
+            if snap.current > 0:
+                # calculate time to full, the snapshot cannot change between the check above and here
+                self._publisher["/TimeToGo"] = (
+                    (100 - snap.soc) * self._bat.capacity * 36 / snap.current
+                )
             else:
-                # discharging
-                self._dbusservice["/ConsumedAmphours"] += (
-                    self._bat.current * 0.016667
-                )  # Ah
-                self._dbusservice["/History/TotalAhDrawn"] += (
-                    self._bat.current * 0.016667
-                )  # Ah
-                self._dbusservice["/History/DischargedEnergy"] += (
-                    -power * 1.666667e-5
-                )  # kWh
-
                 # calculate time to empty
                 try:
-                    self._dbusservice["/TimeToGo"] = (
-                        self._bat.soc * self._bat.capacity * 36 / (-self._bat.current)
+                    self._publisher["/TimeToGo"] = (
+                        snap.soc * self._bat.capacity * 36 / (-snap.current)
                     )
                 except:
-                    self._dbusservice["/TimeToGo"] = (
-                        self._bat.soc * self._bat.capacity * 36
+                    self._publisher["/TimeToGo"] = (
+                        snap.soc * self._bat.capacity * 36
                     )
 
             self._safe_history()
 
+
+def watch_bus(bat):
+    # single threaded operation, frames are decoded on the GLib main loop in batches
+    # whenever the CAN socket becomes readable
+    def on_readable(*args):
+        exit_on_error(bat.drain)
         return True
 
+    try:
+        GLib.io_add_watch(bat.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, on_readable)
+    except NotImplementedError:
+        # e.g. a replayed log, poll instead
+        GLib.timeout_add(50, on_readable)
+
 
 # === All code below is to simply run it from the commandline for debugging purposes ===
 
@@ -499,15 +754,106 @@ class DbusBatteryService:
 # dbus -y com.victronenergy.battery /Soc GetValue
 
 
+def per_pack(values, count, name):
+    # a command line option given once applies to all packs, otherwise once per interface
+    if not values or len(values) == 1:
+        return (values or [None]) * count
+    if len(values) != count:
+        raise ValueError("%d %s values for %d interfaces" % (len(values), name, count))
+    return values
+
+
 def main():
+
     parser = ArgumentParser(description="dbus_ubms", add_help=True)
     parser.add_argument(
         "-d", "--debug", help="enable debug logging", action="store_true"
     )
-    parser.add_argument("-i", "--interface", help="CAN interface")
-    parser.add_argument("-c", "--capacity", help="capacity in Ah")
-    parser.add_argument("-v", "--voltage", help="maximum charge voltage V")
+    parser.add_argument(
+        "-i",
+        "--interface",
+        action="append",
+        help="CAN interface, repeat for several packs in one process",
+    )
+    parser.add_argument(
+        "-c", "--capacity", action="append", help="capacity in Ah, per interface"
+    )
+    parser.add_argument(
+        "-v",
+        "--voltage",
+        action="append",
+        help="maximum charge voltage V, per interface",
+    )
+    parser.add_argument(
+        "-n",
+        "--instance",
+        action="append",
+        type=int,
+        help="device instance, per interface, default 0, 1, ...",
+    )
+    parser.add_argument(
+        "--modules",
+        action="append",
+        type=int,
+        help="number of modules, per interface, default discovered from the bus",
+    )
+    parser.add_argument(
+        "--strings",
+        action="append",
+        type=int,
+        help="number of parallel strings, per interface, default from the charge voltage",
+    )
+    parser.add_argument(
+        "--cells",
+        action="append",
+        type=int,
+        help="cells per module, per interface, default discovered from the bus",
+    )
     parser.add_argument("-p", "--print", help="print only")
+    parser.add_argument(
+        "-r",
+        "--replay",
+        action="append",
+        help="replay a candump log file instead of using CAN, per interface",
+    )
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed, 1 is real time, 0 as fast as possible",
+    )
+    parser.add_argument(
+        "-e",
+        "--event-driven",
+        help="publish when new data was decoded instead of polling at a fixed interval",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--single-thread",
+        help="decode frames on the GLib main loop instead of a CAN notifier thread",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--record",
+        help="keep the last received frames in a flight recorder file per interface in this directory",
+    )
+    parser.add_argument(
+        "--record-frames",
+        type=int,
+        default=262144,
+        help="number of frames kept by the flight recorder, 24 bytes each",
+    )
+    parser.add_argument(
+        "--cache",
+        help="directory for the identity of the last verified BMS per interface, enables warm starts",
+    )
+    parser.add_argument(
+        "--save-interval",
+        type=int,
+        default=600,
+        help="seconds between writes of the history to localsettings, default 600",
+    )
 
     args = parser.parse_args()
 
@@ -518,20 +864,32 @@ def main():
 
     if not args.interface:
         logging.info("No CAN interface specified, using default can0")
-        args.interface = "can0"
+        args.interface = ["can0"]
 
     if not args.capacity:
         logging.warning("Battery capacity not specified, using default (130Ah)")
-        args.capacity = 130
+        args.capacity = [130]
 
     if not args.voltage:
         logging.error("Maximum charge voltage not specified. Exiting.")
         return
 
-    os.system("ip link set can0 type can bitrate 250000")
-    os.system("ifconfig can0 up")
-
-    logging.info("Starting dbus_ubms %s on %s " % (VERSION, args.interface))
+    packs = len(args.interface)
+    try:
+        capacities = per_pack(args.capacity, packs, "capacity")
+        voltages = per_pack(args.voltage, packs, "voltage")
+        replays = per_pack(args.replay, packs, "replay")
+        topologies = zip(
+            per_pack(args.modules, packs, "modules"),
+            per_pack(args.strings, packs, "strings"),
+            per_pack(args.cells, packs, "cells"),
+        )
+        instances = args.instance or list(range(packs))
+        if len(instances) != packs:
+            raise ValueError("%d instances for %d interfaces" % (len(instances), packs))
+    except ValueError as e:
+        logging.error("%s. Exiting.", e)
+        return
 
     from dbus.mainloop.glib import DBusGMainLoop
 
@@ -540,20 +898,83 @@ def main():
         gobject.threads_init()
     DBusGMainLoop(set_as_default=True)
 
-    DbusBatteryService(
-        servicename="com.victronenergy.battery",
-        connection=args.interface,
-        deviceinstance=0,
-        capacity=int(args.capacity),
-        voltage=float(args.voltage),
-    )
+    # one battery and dbus service per interface, all sharing this process and main loop
+    services = []
+    setupStart = IMPORTED
+    for interface, capacity, voltage, instance, replay, topology in zip(
+        args.interface, capacities, voltages, instances, replays, topologies
+    ):
+        if services:
+            setupStart = monotonic()
+        modules, strings, cellsPerModule = topology
+        bus = None
+        if replay:
+            from canreplay import CandumpBus
+
+            logging.info("Replaying %s at speed %g", replay, args.speed)
+            bus = CandumpBus(replay, speed=args.speed, loop=True)
+        else:
+            os.system("ip link set %s type can bitrate 250000" % interface)
+            os.system("ifconfig %s up" % interface)
+
+        recorder = None
+        if args.record:
+            from flightrecorder import FlightRecorder
+
+            recorder = FlightRecorder(
+                os.path.join(args.record, "ubms-%s.rec" % interface), args.record_frames
+            )
+
+        cache = None
+        if args.cache:
+            from identitycache import IdentityCache
+
+            cache = IdentityCache(os.path.join(args.cache, "ubms-%s.json" % interface))
+
+        logging.info("Starting dbus_ubms %s on %s " % (VERSION, interface))
+
+        try:
+            service = DbusBatteryService(
+                servicename="com.victronenergy.battery",
+                connection=interface,
+                deviceinstance=instance,
+                capacity=int(capacity),
+                voltage=float(voltage),
+                bus=bus,
+                threaded=not args.single_thread,
+                eventDriven=args.event_driven,
+                saveInterval=args.save_interval,
+                recorder=recorder,
+                cache=cache,
+                modules=modules,
+                strings=strings,
+                cellsPerModule=cellsPerModule,
+                setupStart=setupStart,
+            )
+        except ValueError as e:
+            # e.g. --strings that do not divide the modules of the pack
+            logging.error("%s. Exiting.", e)
+            for service in services:
+                service.shutdown()
+            return
+
+        if args.single_thread:
+            watch_bus(service._bat)
+        services.append(service)
 
     logging.debug(
         "Connected to dbus, and switching over to GLib.MainLoop() (= event based)"
     )
     mainloop = GLib.MainLoop()
+
+    # save the history on a regular stop, e.g. svc -d
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, mainloop.quit)
     mainloop.run()
 
+    for service in services:
+        service.shutdown()
+
 
 if __name__ == "__main__":
     main()
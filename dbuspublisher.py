@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Change-only, batched publishing of dbus values.
+Values assigned during one update cycle are collected, values equal to the last published one are dropped
+and the rest is sent with flush() as a single ItemsChanged signal, if the VeDbusService supports it.
+
+"""
+
+import logging
+
+
+class DbusPublisher:
+    def __init__(self, service):
+        self._service = service
+        self._published = {}
+        self._pending = {}
+        # VeDbusService used as context manager batches all changes into one ItemsChanged signal,
+        # older velib versions emit a PropertiesChanged signal per item
+        self._batched = hasattr(type(service), "__enter__")
+        if not self._batched:
+            logging.info("velib without ItemsChanged support, publishing item by item")
+
+    def __getitem__(self, path):
+        # the value as it will be after the next flush
+        try:
+            return self._pending[path]
+        except KeyError:
+            pass
+        try:
+            return self._published[path]
+        except KeyError:
+            return self._service[path]
+
+    def __setitem__(self, path, value):
+        if path in self._published and self._published[path] == value:
+            # back at the published value, drop any change queued this cycle
+            self._pending.pop(path, None)
+        else:
+            self._pending[path] = value
+
+    def set_many(self, paths, values):
+        # assign values to the paths of the same index in one pass, e.g. all cells of a pack
+        published = self._published
+        pending = self._pending
+        for path, value in zip(paths, values):
+            if path in published and published[path] == value:
+                pending.pop(path, None)
+            else:
+                pending[path] = value
+
+    def flush(self):
+        # publish all changes of this cycle, returns the number of changed items
+        changes = self._pending
+        if not changes:
+            return 0
+        self._pending = {}
+
+        if self._batched:
+            with self._service as s:
+                for path, value in changes.items():
+                    s[path] = value
+        else:
+            for path, value in changes.items():
+                self._service[path] = value
+
+        self._published.update(changes)
+        return len(changes)
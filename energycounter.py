@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""
+Coulomb and energy counter integrating the pack current and power of every 0xC1 frame over the
+frame timestamps (trapezoidal rule). Charge and discharge are summed separately as positive totals,
+readers take differences of the totals, so the counter never needs to be reset.
+
+"""
+
+
+class EnergyCounter:
+    def __init__(self, maxGap=5.0):
+        # intervals longer than maxGap seconds (bus silent, BMS off) are not integrated
+        self.maxGap = maxGap
+        self.chargedAh = 0.0
+        self.dischargedAh = 0.0
+        self.chargedWh = 0.0
+        self.dischargedWh = 0.0
+        self._time = None
+        self._current = 0
+        self._power = 0.0
+
+    def add(self, timestamp, voltage, current):
+        # add a sample of current (A) and voltage (V) measured at timestamp (s)
+        power = voltage * current
+        if self._time is not None:
+            dt = timestamp - self._time
+            if 0 < dt <= self.maxGap:
+                # mean of both samples times dt, in As and Ws converted to Ah and Wh
+                charge = (current + self._current) * dt / 7200.0
+                energy = (power + self._power) * dt / 7200.0
+                if charge >= 0:
+                    self.chargedAh += charge
+                else:
+                    self.dischargedAh -= charge
+                if energy >= 0:
+                    self.chargedWh += energy
+                else:
+                    self.dischargedWh -= energy
+        self._time = timestamp
+        self._current = current
+        self._power = power
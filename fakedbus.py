@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+In-process stand-ins for velib's VeDbusService and SettingsDevice, to run DbusBatteryService headless.
+Item assignments and the signals velib would emit (PropertiesChanged per item, one ItemsChanged per
+batch) are recorded with their perf_counter time instead of going to a D-Bus daemon.
+
+install() additionally provides minimal gi, dbus and velib modules if they cannot be imported, so
+dbus_ubms can be loaded on a machine without the Venus OS environment.
+
+"""
+
+import logging
+import os
+import sys
+import types
+
+from time import perf_counter
+
+
+def connection():
+    # FakeVeDbusService needs no dbus connection
+    return None
+
+
+class FakeVeDbusService:
+    def __init__(self, servicename, bus=None, register=True):
+        self.servicename = servicename
+        self.bus = bus
+        self.registered = False
+        self._values = {}
+        self._batch = None
+        # (time, path, value) of every assignment, also unchanged ones
+        self.assignments = []
+        # (time, signal name, {path: value}) as velib would emit them
+        self.signals = []
+        if register:
+            self.register()
+
+    def add_path(
+        self,
+        path,
+        value,
+        description="",
+        writeable=False,
+        onchangecallback=None,
+        gettextcallback=None,
+        **kwargs
+    ):
+        if path in self._values:
+            raise ValueError("duplicate path %s" % path)
+        self._values[path] = value
+
+    def register(self):
+        self.registered = True
+
+    def __getitem__(self, path):
+        return self._values[path]
+
+    def __setitem__(self, path, value):
+        now = perf_counter()
+        self.assignments.append((now, path, value))
+        if self._values[path] == value:
+            # velib does not signal unchanged values
+            return
+        self._values[path] = value
+        if not self.registered:
+            return
+        if self._batch is not None:
+            self._batch[path] = value
+        else:
+            self.signals.append((now, "PropertiesChanged", {path: value}))
+
+    def __enter__(self):
+        self._batch = {}
+        return self
+
+    def __exit__(self, *exc):
+        batch, self._batch = self._batch, None
+        if batch:
+            self.signals.append((perf_counter(), "ItemsChanged", batch))
+
+
+class FakeSettingsDevice:
+    def __init__(self, supportedSettings, eventCallback=None):
+        # setting name -> [path, default, min, max], starting at the defaults
+        self._values = {name: spec[1] for name, spec in supportedSettings.items()}
+        self._eventCallback = eventCallback
+        # (time, name, value) of every write
+        self.writes = []
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        self.writes.append((perf_counter(), name, value))
+        self._values[name] = value
+
+
+def install():
+    # provide stand-in modules for what dbus_ubms imports but this machine lacks, returns their names
+    installed = []
+
+    def missing(name):
+        if name in sys.modules:
+            return False
+        try:
+            __import__(name)
+            return False
+        except ImportError:
+            return True
+
+    if missing("gi.repository"):
+        GLib = types.SimpleNamespace(
+            PRIORITY_DEFAULT=0,
+            PRIORITY_HIGH=-100,
+            IO_IN=1,
+            timeout_add=lambda *args: 0,
+            timeout_add_seconds=lambda *args: 0,
+            io_add_watch=lambda *args: 0,
+        )
+        gi = types.ModuleType("gi")
+        gi.repository = types.ModuleType("gi.repository")
+        gi.repository.GLib = GLib
+        sys.modules["gi"] = gi
+        sys.modules["gi.repository"] = gi.repository
+        installed.append("gi")
+
+    if missing("dbus"):
+        sys.modules["dbus"] = types.ModuleType("dbus")
+        installed.append("dbus")
+
+    # velib, looked up in ext/velib_python by dbus_ubms
+    standins = {
+        "vedbus": {"VeDbusService": FakeVeDbusService},
+        "settingsdevice": {
+            "SettingsDevice": lambda bus, supportedSettings, eventCallback, **kw: (
+                FakeSettingsDevice(supportedSettings, eventCallback)
+            )
+        },
+        "ve_utils": {"exit_on_error": lambda func, *args: func(*args)},
+    }
+    sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext/velib_python"))
+    for name, attributes in standins.items():
+        if missing(name):
+            module = types.ModuleType(name)
+            module.__dict__.update(attributes)
+            sys.modules[name] = module
+            installed.append(name)
+
+    if installed:
+        logging.info("Using stand-ins for %s", ", ".join(installed))
+    return installed
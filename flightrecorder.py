@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Flight recorder keeping the last received CAN frames in a memory mapped ring file.
+Each frame is a fixed 24 byte record: timestamp (double), can_id incl. flags (uint32), dlc (uint8),
+3 padding bytes and 8 data bytes, i.e. a linux can_frame prefixed with its receive time.
+The file lives in the page cache, so the records survive a crash of the process.
+
+ python3 flightrecorder.py /data/ubms-can0.rec -s 1535106758 -e 1535106800 > window.log
+
+exports a time window as candump log for the replay path (canreplay.py, dbus_ubms.py --replay).
+
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from argparse import ArgumentParser
+
+from canbatch import CAN_FRAME
+
+# magic, format version, capacity in records, reserved, number of records ever written
+_HEADER = struct.Struct("<4sIIIQ")
+_MAGIC = b"UBFR"
+_VERSION = 1
+_RECORD = struct.Struct("<dIB3x8s")
+_TIMESTAMP = struct.Struct("<d")
+_SEQUENCE_OFFSET = 16
+
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+
+# raw can_frames (native byte order) can be copied into records as they are
+_RAW_COPY = sys.byteorder == "little" and CAN_FRAME.size + 8 == _RECORD.size
+
+
+class FlightRecorder:
+    def __init__(self, path, records=262144):
+        self.path = path
+        size = _HEADER.size + records * _RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, _HEADER.size, 0)
+            if len(header) == _HEADER.size and _HEADER.unpack(header)[:3] == (
+                _MAGIC,
+                _VERSION,
+                records,
+            ):
+                # continue an existing recording
+                self.written = _HEADER.unpack(header)[4]
+            else:
+                if header:
+                    logging.warning("Flight recorder %s reinitialized", path)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, _HEADER.pack(_MAGIC, _VERSION, records, 0, 0), 0)
+                self.written = 0
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.records = records
+
+    def _offset(self):
+        return _HEADER.size + (self.written % self.records) * _RECORD.size
+
+    def _commit(self, count):
+        self.written += count
+        struct.pack_into("<Q", self._map, _SEQUENCE_OFFSET, self.written)
+
+    def record(self, msg):
+        # a can.Message
+        canId = msg.arbitration_id
+        if msg.is_extended_id:
+            canId |= CAN_EFF_FLAG
+        if msg.is_remote_frame:
+            canId |= CAN_RTR_FLAG
+        _RECORD.pack_into(
+            self._map, self._offset(), msg.timestamp, canId, msg.dlc, msg.data or b""
+        )
+        self._commit(1)
+
+    def record_frames(self, buffer, count, timestamp):
+        # count raw can_frames from buffer as read by canbatch.RawFrameReader
+        mm = self._map
+        view = memoryview(buffer)
+        size = CAN_FRAME.size
+        for start in range(0, count * size, size):
+            offset = self._offset()
+            _TIMESTAMP.pack_into(mm, offset, timestamp)
+            if _RAW_COPY:
+                mm[offset + 8 : offset + _RECORD.size] = view[start : start + size]
+            else:
+                canId, dlc, data = CAN_FRAME.unpack_from(buffer, start)
+                _RECORD.pack_into(mm, offset, timestamp, canId, dlc, data)
+            self.written += 1
+        self._commit(0)
+
+    def frames(self, start=0, end=float("inf")):
+        # recorded (timestamp, can_id, dlc, data) in the order received, within start <= timestamp <= end
+        first = max(0, self.written - self.records)
+        for seq in range(first, self.written):
+            offset = _HEADER.size + (seq % self.records) * _RECORD.size
+            timestamp, canId, dlc, data = _RECORD.unpack_from(self._map, offset)
+            if start <= timestamp <= end:
+                yield timestamp, canId, dlc, data[:dlc]
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+
+
+def candump_line(timestamp, canId, dlc, data, channel):
+    # one line in candump -l format
+    if canId & CAN_EFF_FLAG:
+        frameId = "%08X" % (canId & CAN_EFF_MASK)
+    else:
+        frameId = "%03X" % (canId & 0x7FF)
+    payload = "R" if canId & CAN_RTR_FLAG else data.hex().upper()
+    return "(%.6f) %s %s#%s" % (timestamp, channel, frameId, payload)
+
+
+def open_recording(path):
+    # an existing recording, capacity taken from its header
+    with open(path, "rb") as f:
+        magic, version, records, _, _ = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("%s is not a flight recorder file" % path)
+    return FlightRecorder(path, records)
+
+
+# === All code below is to export a recording from the commandline ===
+def main():
+    parser = ArgumentParser(description="export a flight recording as candump log")
+    parser.add_argument("recording", help="flight recorder file")
+    parser.add_argument(
+        "-s", "--start", type=float, default=0, help="first timestamp (epoch s)"
+    )
+    parser.add_argument(
+        "-e", "--end", type=float, default=float("inf"), help="last timestamp (epoch s)"
+    )
+    parser.add_argument(
+        "-l",
+        "--last",
+        type=float,
+        help="only the last seconds before now, instead of start and end",
+    )
+    parser.add_argument(
+        "-i", "--interface", default="can0", help="interface name written to the log"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)-8s %(message)s", level=logging.INFO)
+
+    start, end = args.start, args.end
+    if args.last is not None:
+        start = time.time() - args.last
+
+    recorder = open_recording(args.recording)
+    count = 0
+    for frame in recorder.frames(start, end):
+        print(candump_line(*frame, args.interface))
+        count += 1
+    recorder.close()
+    logging.info("Exported %d frames", count)
+
+
+if __name__ == "__main__":
+    main()
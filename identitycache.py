@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Identity of the last verified U-BMS (firmware, type, hardware revision and pack topology) kept in a small
+json file, so a restart can start publishing right away and verify the BMS in the background.
+
+"""
+
+import json
+import logging
+import os
+
+# what an identity holds, all integers
+IDENTITY_KEYS = (
+    "firmwareVersion",
+    "bms_type",
+    "hw_rev",
+    "modules",
+    "strings",
+    "cellsPerModule",
+)
+
+
+class IdentityCache:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # the cached identity as dict, None if there is none, a broken cache is removed
+        try:
+            with open(self.path) as f:
+                identity = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring identity cache %s: %s", self.path, e)
+            self.clear()
+            return None
+        problem = _check(identity)
+        if problem:
+            logging.warning("Dropping identity cache %s: %s", self.path, problem)
+            self.clear()
+            return None
+        return identity
+
+    def save(self, identity):
+        # write a new file and rename it, a crash leaves either the old or the new identity
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(identity, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning("Cannot write identity cache %s: %s", self.path, e)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Cannot remove identity cache %s: %s", self.path, e)
+
+
+def _check(identity):
+    # what is wrong with a loaded identity, None if it can be used
+    if not isinstance(identity, dict):
+        return "not an object"
+    for key in IDENTITY_KEYS:
+        value = identity.get(key)
+        if type(value) is not int or value < 0:
+            return "%s is %r" % (key, value)
+    if min(identity["modules"], identity["strings"], identity["cellsPerModule"]) < 1:
+        return "empty pack layout"
+    if identity["modules"] % identity["strings"]:
+        return "%d modules in %d strings" % (identity["modules"], identity["strings"])
+    return None
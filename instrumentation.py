@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Counters on the hot paths, cheap enough to stay enabled in production.
+The decoder only increments integers and stores timestamps: frames and last receive time per arbitration ID,
+data bytes, unknown frames, receive batch sizes and power of two histograms of durations in ns. Frame by frame
+decoding times only every DECODE_SAMPLE-th frame of an ID, batches are timed as a whole.
+Percentiles, rates and bus load are computed from them when published.
+
+"""
+
+import time
+
+from array import array
+
+_BUCKETS = 40
+# frames of one arbitration ID per timed frame, a power of two
+DECODE_SAMPLE = 64
+
+
+class Histogram:
+    # durations in ns, bucket b counts the values of bit length b, i.e. [2**(b-1), 2**b)
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * _BUCKETS))
+        self.max = 0
+
+    def add(self, ns):
+        self.counts[min(ns.bit_length(), _BUCKETS - 1)] += 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        # upper bound in ns of the bucket holding the p-th percentile, None without samples
+        counts = self.counts.tolist()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = total * p / 100.0
+        seen = 0
+        for b, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return min(1 << b, self.max)
+        return self.max
+
+
+class DecodeStats:
+    def __init__(self, ids):
+        # arbitration IDs the decoder handles, the ones published
+        self.ids = tuple(ids)
+        # frames and timestamp of the last frame per standard arbitration ID
+        self.frames = array("Q", bytes(8 * 0x800))
+        self.lastSeen = array("d", bytes(8 * 0x800))
+        # data bytes of all decoded frames
+        self.octets = 0
+        # frames without decoder, e.g. let through by a filter mask
+        self.unknown = 0
+        # decode time per frame, sampled when decoding frame by frame
+        self.decode = Histogram()
+        # raw frames waiting on the socket per wakeup, not counted with can.Notifier
+        self.lastBatch = 0
+        self.maxBatch = 0
+
+    def batch(self, count):
+        self.lastBatch = count
+        if count > self.maxBatch:
+            self.maxBatch = count
+
+    @property
+    def total(self):
+        return sum(self.frames.tolist()) + self.unknown
+
+
+class RateMonitor:
+    """
+    Frame rates per arbitration ID and the bus load they cause, averaged over the time between two
+    calls of update(). Load assumes standard frames of 47 bits plus data, 20% stuff bits, at bitrate.
+
+    """
+
+    def __init__(self, stats, bitrate=250000):
+        self.stats = stats
+        self.bitrate = bitrate
+        self._frames = array("Q", stats.frames)
+        self._octets = stats.octets
+        self._time = time.monotonic()
+        self.rates = [0.0] * len(stats.ids)
+        self.framesPerSecond = 0.0
+        self.load = 0.0
+
+    def update(self):
+        now = time.monotonic()
+        elapsed = now - self._time
+        if elapsed <= 0:
+            return
+        stats = self.stats
+        frames = stats.frames
+        previous = self._frames
+        total = 0
+        for i, canId in enumerate(stats.ids):
+            count = frames[canId] - previous[canId]
+            previous[canId] = frames[canId]
+            self.rates[i] = count / elapsed
+            total += count
+        octets = stats.octets - self._octets
+        self._octets = stats.octets
+        self._time = now
+        self.framesPerSecond = total / elapsed
+        self.load = (total * 47 + octets * 8) * 1.2 / (self.bitrate * elapsed)
+
+
+def interface_drops(interface):
+    # frames the kernel dropped on a CAN interface, None if there is no such network interface
+    try:
+        with open("/sys/class/net/%s/statistics/rx_dropped" % interface) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Headless end-to-end load test of UbmsBattery and DbusBatteryService.
+Frames of a replayed candump log or of the U-BMS simulator are decoded on the calling thread and every new
+snapshot is published through _update, as with --event-driven, into the in-process stand-ins of fakedbus.
+No D-Bus daemon, localsettings or velib is needed. Reports CPU time per frame, publishes (dbus signals) and
+items per second and the latency from reading a batch of frames to the signal carrying its values.
+
+ python3 loadtest.py -r candumps/candump-2018-08-24_103237.log -n 200000
+ python3 loadtest.py -m 11 -n 200000 -o result.json
+
+"""
+
+import json
+import logging
+import platform
+import time
+
+from argparse import ArgumentParser
+
+import fakedbus
+
+
+def percentile(values, p):
+    # p-th percentile of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(service, frames):
+    # decode and publish until at least frames frames were read, returns the results
+    bat = service._bat
+    fake = service._dbusservice
+    signalsStart = len(fake.signals)
+    assignmentsStart = len(fake.assignments)
+    latencies = []
+    count = 0
+
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    while count < frames:
+        read = time.perf_counter()
+        n = bat.drain()
+        if n == 0:
+            # end of a log that does not loop
+            break
+        count += n
+        if bat.snapshot.version != service.lastVersion:
+            first = len(fake.signals)
+            service._update()
+            latencies += [signal[0] - read for signal in fake.signals[first:]]
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+
+    signals = len(fake.signals) - signalsStart
+    items = sum(len(signal[2]) for signal in fake.signals[signalsStart:])
+    latencies.sort()
+    return {
+        "frames": count,
+        "snapshots": bat.snapshot.version,
+        "assignments": len(fake.assignments) - assignmentsStart,
+        "signals": signals,
+        "cpu_us_per_frame": cpu * 1e6 / max(1, count),
+        "frames_per_s": count / wall,
+        "signals_per_s": signals / wall,
+        "items_per_s": items / wall,
+        "latency_p50_us": (percentile(latencies, 50) or 0) * 1e6,
+        "latency_p99_us": (percentile(latencies, 99) or 0) * 1e6,
+        "latency_max_us": (latencies[-1] if latencies else 0) * 1e6,
+    }
+
+
+# === All code below is to run the load test from the commandline ===
+def main():
+    parser = ArgumentParser(description="headless dbus_ubms load test")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-r", "--replay", help="candump log to replay in a loop")
+    source.add_argument(
+        "-m",
+        "--modules",
+        type=int,
+        default=8,
+        help="number of modules of the simulated U-BMS, default 8",
+    )
+    parser.add_argument(
+        "-n", "--frames", type=int, default=100000, help="number of frames to process"
+    )
+    parser.add_argument(
+        "-c", "--capacity", type=int, default=650, help="capacity in Ah"
+    )
+    parser.add_argument(
+        "-v", "--voltage", type=float, default=29.0, help="maximum charge voltage V"
+    )
+    parser.add_argument("-o", "--output", help="write results to this json file")
+    parser.add_argument(
+        "-d", "--debug", help="enable debug logging", action="store_true"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(levelname)-8s %(message)s",
+        level=(logging.DEBUG if args.debug else logging.INFO),
+    )
+
+    fakedbus.install()
+    from dbus_ubms import DbusBatteryService
+
+    # pack layout of the simulator, a replayed log is discovered
+    strings = None
+    if args.replay:
+        from canreplay import CandumpBus
+
+        bus = CandumpBus(args.replay, speed=0, loop=True)
+        source = args.replay
+    else:
+        from ubmssim import SimulatedBus
+
+        bus = SimulatedBus(modules=args.modules, speed=0, seed=1)
+        strings = bus.simulator.strings
+        source = "simulator, %d modules in %d strings" % (args.modules, strings)
+
+    service = DbusBatteryService(
+        servicename="com.victronenergy.battery",
+        connection="loadtest",
+        deviceinstance=0,
+        capacity=args.capacity,
+        voltage=args.voltage,
+        bus=bus,
+        strings=strings,
+        threaded=False,
+        eventDriven=True,
+        serviceClass=fakedbus.FakeVeDbusService,
+        settingsFactory=fakedbus.FakeSettingsDevice,
+        connectionFactory=fakedbus.connection,
+    )
+    results = run(service, args.frames)
+    service.shutdown()
+
+    logging.info("Load test on %s", source)
+    for name, value in results.items():
+        logging.info("%-20s %12.1f", name, value)
+
+    if args.output:
+        report = {
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "time": time.time(),
+            "source": source,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""
+Local cache in front of a velib SettingsDevice.
+Reads are served from the cache, writes only mark a setting dirty if it moved away from the
+persisted value by more than its threshold. Dirty settings are written to localsettings with flush(),
+which the owner calls on a fixed cadence and on shutdown, so each D-Bus write and flash update
+carries a real change.
+
+"""
+
+import logging
+
+
+class SettingsCache:
+    def __init__(self, settings, names, thresholds=None):
+        self._settings = settings
+        # one D-Bus read per setting, at startup only
+        self._values = {name: settings[name] for name in names}
+        self._persisted = dict(self._values)
+        self._thresholds = thresholds or {}
+        self._dirty = set()
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        self._values[name] = value
+        if abs(value - self._persisted[name]) > self._thresholds.get(name, 0):
+            self._dirty.add(name)
+        else:
+            self._dirty.discard(name)
+
+    def changed(self, name, oldvalue, newvalue):
+        # eventCallback of the SettingsDevice, the setting was changed on dbus, e.g. by the GUI
+        if name in self._values:
+            self._values[name] = newvalue
+            self._persisted[name] = newvalue
+            self._dirty.discard(name)
+
+    def flush(self):
+        # write the dirty settings to localsettings, returns the number written
+        count = len(self._dirty)
+        for name in self._dirty:
+            value = self._values[name]
+            self._settings[name] = value
+            self._persisted[name] = value
+        self._dirty.clear()
+        if count:
+            logging.debug("Saved %d settings to localsettings", count)
+        return count
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+In-memory history of the decoded values with fixed memory use.
+Samples are averaged into buckets of increasing length, by default 1s kept for an hour, 1min for a day
+and 15min for a month. Each tier is a preallocated ring of float arrays, a completed bucket of one tier
+is fed as sample into the next, so the cost per sample does not depend on the number of tiers.
+
+"""
+
+import threading
+
+from array import array
+
+# (bucket length in s, number of buckets)
+DEFAULT_TIERS = ((1, 3600), (60, 1440), (900, 2880))
+
+
+class _Tier:
+    def __init__(self, step, slots, channels):
+        self.step = step
+        self.slots = slots
+        self.channels = channels
+        self.times = array("d", bytes(8 * slots))
+        self.values = array("f", bytes(4 * slots * channels))
+        self.head = 0
+        self.count = 0
+        # the bucket being filled
+        self.bucket = None
+        self.sums = array("d", bytes(8 * channels))
+        self.samples = 0
+
+    def add(self, timestamp, values):
+        # returns (bucket start, values) of a bucket completed by this sample, else None
+        completed = None
+        bucket = int(timestamp // self.step)
+        if bucket != self.bucket:
+            if self.samples:
+                completed = self._commit()
+            self.bucket = bucket
+        sums = self.sums
+        for c, v in enumerate(values):
+            sums[c] += v
+        self.samples += 1
+        return completed
+
+    def _commit(self):
+        base = self.head * self.channels
+        stored = self.values
+        sums = self.sums
+        n = self.samples
+        for c in range(self.channels):
+            stored[base + c] = sums[c] / n
+            sums[c] = 0.0
+        self.samples = 0
+        self.times[self.head] = self.bucket * self.step
+        completed = (self.times[self.head], stored[base : base + self.channels])
+        self.head = (self.head + 1) % self.slots
+        self.count = min(self.count + 1, self.slots)
+        return completed
+
+    def oldest(self):
+        return self.times[(self.head - self.count) % self.slots] if self.count else None
+
+    def covers(self, start):
+        # True if no bucket at or after start has been overwritten yet
+        return self.count < self.slots or self.oldest() <= start
+
+    def series(self, channel, start, end):
+        result = []
+        for i in range(self.head - self.count, self.head):
+            i %= self.slots
+            t = self.times[i]
+            if start <= t <= end:
+                result.append((t, self.values[i * self.channels + channel]))
+        return result
+
+
+class TelemetryRing:
+    """
+    History of a fixed number of channels, add() takes one value per channel.
+    Memory is allocated once: 4 bytes per channel and bucket plus 8 bytes per bucket.
+
+    """
+
+    def __init__(self, channels, tiers=DEFAULT_TIERS):
+        self.channels = channels
+        self._tiers = [_Tier(step, slots, channels) for step, slots in tiers]
+        # add() runs on the CAN thread, queries on the dbus side
+        self._lock = threading.Lock()
+
+    @property
+    def memory(self):
+        # bytes held by the ring buffers
+        return sum(
+            t.values.itemsize * len(t.values) + t.times.itemsize * len(t.times)
+            for t in self._tiers
+        )
+
+    def add(self, timestamp, values):
+        with self._lock:
+            sample = (timestamp, values)
+            for tier in self._tiers:
+                sample = tier.add(*sample)
+                if sample is None:
+                    break
+
+    def query(self, channel, start=0, end=float("inf"), step=None):
+        """
+        Averaged values of channel with start <= bucket start <= end as list of (timestamp, value).
+        Without step the finest tier still holding start is used, else the tier with that bucket length.
+
+        """
+        with self._lock:
+            if step is not None:
+                tiers = [t for t in self._tiers if t.step == step]
+                if not tiers:
+                    raise ValueError("No tier with %ss buckets" % step)
+                tier = tiers[0]
+            else:
+                tier = next(
+                    (t for t in self._tiers if t.covers(start)), self._tiers[-1]
+                )
+            return tier.series(channel, start, end)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Columnar file format for decoded U-BMS telemetry, the storage layer of the offline analysis.
+Every column holds one value per snapshot as fixed width little endian numbers: time (double), pack values,
+per module voltage/current/SOC/temperature (float) and per cell voltages (uint16 mV). Columns are stored
+one after the other, so reading one value over a week of history touches only that column's pages.
+Every interval-th timestamp is repeated in a small sparse index, a time range is found by a binary
+search in the index and then within one block of the time column.
+
+Files are written once, by TelemetryWriter (e.g. analyze.py --telemetry DIR), and read through mmap:
+TelemetryFile.column returns memoryviews and TelemetryFile.array NumPy arrays on the mapped file, no
+values are copied.
+
+ python3 telemetryfile.py /data/analysis/candump-2018-08-24_103237-can0.ubt
+ python3 telemetryfile.py pack.ubt -s 1535106758 -e 1535106800 -c voltage,current,moduleTemp[0]
+
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left, bisect_right
+
+# magic, format version, number of columns, rows per index entry, number of rows, first and last time
+_HEADER = struct.Struct("<4sIIIQdd")
+_MAGIC = b"UBTC"
+_VERSION = 1
+# name, array typecode, offset of the values in the file
+_COLUMN = struct.Struct("<31scQ")
+# columns start at multiples of 8 bytes, so every value is aligned in the mapping
+_ALIGN = 8
+
+# pack values taken from BatterySnapshot, (name, typecode)
+PACK_COLUMNS = (
+    ("soc", "B"),
+    ("mode", "B"),
+    ("voltage", "f"),
+    ("current", "f"),
+    ("maxCellVoltage", "f"),
+    ("minCellVoltage", "f"),
+    ("maxCellTemperature", "f"),
+    ("minCellTemperature", "f"),
+    ("numberOfModulesBalancing", "B"),
+    ("shutdownReason", "B"),
+)
+# per module values, one column per module named e.g. moduleTemp[3]
+MODULE_COLUMNS = (
+    ("moduleVoltage", "f"),
+    ("moduleCurrent", "f"),
+    ("moduleSoc", "f"),
+    ("moduleTemp", "f"),
+)
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def telemetry_columns(modules, cellsPerModule):
+    # (name, typecode) of all columns of a pack, the time column first
+    columns = [("time", "d")]
+    columns += PACK_COLUMNS
+    for metric, typecode in MODULE_COLUMNS:
+        columns += [("%s[%d]" % (metric, m), typecode) for m in range(modules)]
+    columns += [("cellVoltage[%d]" % c, "H") for c in range(modules * cellsPerModule)]
+    return columns
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class TelemetryWriter:
+    """
+    Writes the snapshots of one pack to path. Values are collected per column and spooled to temporary
+    files next to path every interval rows, close() assembles the columnar file and replaces path.
+
+    """
+
+    def __init__(self, path, modules, cellsPerModule, interval=1024):
+        self.path = path
+        self.modules = modules
+        self.cellsPerModule = cellsPerModule
+        self.interval = interval
+        self.columns = telemetry_columns(modules, cellsPerModule)
+        self.rows = 0
+        self.last = None
+        self._index = array("d")
+        self._buffers = [array(typecode) for name, typecode in self.columns]
+        directory = os.path.dirname(os.path.abspath(path))
+        self._spools = [tempfile.TemporaryFile(dir=directory) for c in self.columns]
+
+    def add(self, snap):
+        # one BatterySnapshot as row, timestamps must not decrease
+        timestamp = snap.timestamp
+        if self.last is not None and timestamp < self.last:
+            raise ValueError(
+                "Snapshot at %f older than the last row %f" % (timestamp, self.last)
+            )
+        if self.rows % self.interval == 0:
+            self._index.append(timestamp)
+        self.last = timestamp
+
+        buffers = iter(self._buffers)
+        next(buffers).append(timestamp)
+        for (name, typecode), buffer in zip(PACK_COLUMNS, buffers):
+            buffer.append(getattr(snap, name))
+        for values in (
+            snap.moduleVoltage,
+            snap.moduleCurrent,
+            snap.moduleSoc,
+            snap.moduleTemp,
+            snap.cellVoltages,
+        ):
+            for value, buffer in zip(values, buffers):
+                buffer.append(value)
+
+        self.rows += 1
+        if self.rows % self.interval == 0:
+            self._spool()
+
+    def _spool(self):
+        for buffer, spool in zip(self._buffers, self._spools):
+            if not _LITTLE_ENDIAN:
+                buffer.byteswap()
+            buffer.tofile(spool)
+            del buffer[:]
+
+    def close(self):
+        self._spool()
+        # header, column table and index, then the columns
+        offset = _aligned(
+            _HEADER.size + _COLUMN.size * len(self.columns) + 8 * len(self._index)
+        )
+        offsets = []
+        for spool in self._spools:
+            offsets.append(offset)
+            offset = _aligned(offset + spool.tell())
+
+        first = self._index[0] if self._index else 0.0
+        last = self.last if self.last is not None else 0.0
+        index = self._index
+        if not _LITTLE_ENDIAN:
+            index.byteswap()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                _HEADER.pack(
+                    _MAGIC,
+                    _VERSION,
+                    len(self.columns),
+                    self.interval,
+                    self.rows,
+                    first,
+                    last,
+                )
+            )
+            for (name, typecode), start in zip(self.columns, offsets):
+                f.write(_COLUMN.pack(name.encode(), typecode.encode(), start))
+            index.tofile(f)
+            for spool, start in zip(self._spools, offsets):
+                f.write(bytes(start - f.tell()))
+                spool.seek(0)
+                while True:
+                    chunk = spool.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                spool.close()
+        os.replace(tmp, self.path)
+        logging.info(
+            "Wrote %d rows of %d columns to %s", self.rows, len(self.columns), self.path
+        )
+
+
+class TelemetryFile:
+    """
+    A telemetry file mapped read only. Views returned by column() and array() point into the mapping,
+    release them before close().
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, columns, interval, rows, first, last = _HEADER.unpack_from(
+                self._map
+            )
+        except struct.error:
+            magic = version = None
+        if magic != _MAGIC or version != _VERSION:
+            self._map.close()
+            raise ValueError("%s is not a telemetry file" % path)
+        self.interval = interval
+        self.rows = rows
+        self.start = first
+        self.end = last
+        # name -> (typecode, offset)
+        self._columns = {}
+        self.columns = []
+        for i in range(columns):
+            name, typecode, offset = _COLUMN.unpack_from(
+                self._map, _HEADER.size + i * _COLUMN.size
+            )
+            name = name.rstrip(b"\0").decode()
+            self._columns[name] = (typecode.decode(), offset)
+            self.columns.append(name)
+        indexOffset = _HEADER.size + _COLUMN.size * columns
+        self._index = self._view("d", indexOffset, (rows + interval - 1) // interval)
+        self._times = self._view("d", self._columns["time"][1], rows)
+
+    def __len__(self):
+        return self.rows
+
+    def _view(self, typecode, offset, count):
+        size = array(typecode).itemsize
+        view = memoryview(self._map)[offset : offset + count * size]
+        if _LITTLE_ENDIAN:
+            return view.cast(typecode)
+        values = array(typecode, view.tobytes())
+        values.byteswap()
+        return values
+
+    def _row(self, timestamp, search):
+        # row found by search (bisect_left or bisect_right) for timestamp, via the sparse index
+        block = search(self._index, timestamp)
+        interval = self.interval
+        lo = max(0, (block - 1) * interval)
+        hi = min(self.rows, block * interval)
+        return search(self._times, timestamp, lo, hi)
+
+    def rows_between(self, start=None, end=None):
+        # (first, stop) of the rows with start <= time <= end
+        first = 0 if start is None else self._row(start, bisect_left)
+        stop = self.rows if end is None else self._row(end, bisect_right)
+        return first, max(first, stop)
+
+    def column(self, name, start=None, end=None):
+        # values of one column between the times start and end as memoryview on the file
+        try:
+            typecode, offset = self._columns[name]
+        except KeyError:
+            raise KeyError("No column %s in %s" % (name, self.path)) from None
+        first, stop = self.rows_between(start, end)
+        size = array(typecode).itemsize
+        return self._view(typecode, offset + first * size, stop - first)
+
+    def array(self, name, start=None, end=None):
+        # values of one column between the times start and end as read only NumPy array on the file
+        import numpy
+
+        typecode, offset = self._columns[name]
+        first, stop = self.rows_between(start, end)
+        dtype = numpy.dtype(typecode).newbyteorder("<")
+        return numpy.frombuffer(
+            self._map, dtype, stop - first, offset + first * dtype.itemsize
+        )
+
+    def close(self):
+        self._index = self._times = None
+        self._map.close()
+
+
+# === All code below is to inspect a telemetry file from the commandline ===
+def main():
+    parser = ArgumentParser(description="show a U-BMS telemetry file")
+    parser.add_argument("telemetry", help="telemetry file written by analyze.py")
+    parser.add_argument("-s", "--start", type=float, help="first timestamp (epoch s)")
+    parser.add_argument("-e", "--end", type=float, help="last timestamp (epoch s)")
+    parser.add_argument(
+        "-c", "--columns", help="comma separated columns to print as csv"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)-8s %(message)s", level=logging.INFO)
+
+    telemetry = TelemetryFile(args.telemetry)
+    if not args.columns:
+        logging.info(
+            "%d rows from %f to %f, %d columns: %s",
+            telemetry.rows,
+            telemetry.start,
+            telemetry.end,
+            len(telemetry.columns),
+            ", ".join(telemetry.columns),
+        )
+        return
+
+    names = ["time"] + args.columns.split(",")
+    columns = [telemetry.column(name, args.start, args.end) for name in names]
+    print(",".join(names))
+    for row in zip(*columns):
+        print(",".join(str(value) for value in row))
+
+
+if __name__ == "__main__":
+    main()
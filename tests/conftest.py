@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the driver live in the top directory of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
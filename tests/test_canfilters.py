@@ -0,0 +1,41 @@
+import random
+
+import pytest
+
+from canfilters import can_filters
+from ubmsbattery import UbmsBattery
+
+
+def accepted(filters):
+    # standard frame IDs the kernel lets through with these filters
+    return {
+        canId
+        for canId in range(0x800)
+        if any(canId & f["can_mask"] == f["can_id"] & f["can_mask"] for f in filters)
+    }
+
+
+@pytest.mark.parametrize("modules", range(1, 12))
+@pytest.mark.parametrize("charge", (False, True))
+def test_filters_accept_exactly_the_decoder_ids(modules, charge):
+    bat = UbmsBattery(
+        voltage=29.0, capacity=650, connection="test", verify=False, modules=modules
+    )
+    ids = set(bat._decoders)
+    if not charge:
+        ids.discard(0xC2)
+    filters = can_filters(ids)
+    assert accepted(filters) == ids
+    assert all(f["extended"] is False for f in filters)
+
+
+def test_random_id_sets():
+    rng = random.Random(1)
+    for size in (1, 2, 7, 40, 300):
+        ids = set(rng.sample(range(0x800), size))
+        assert accepted(can_filters(ids)) == ids
+
+
+def test_aligned_range_is_one_filter():
+    filters = can_filters(range(0x350, 0x360))
+    assert filters == [{"can_id": 0x350, "can_mask": 0x7F0, "extended": False}]
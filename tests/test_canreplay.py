@@ -0,0 +1,24 @@
+import os
+
+from canreplay import CandumpBus, read_candump
+
+LOG = os.path.join(
+    os.path.dirname(__file__), os.pardir, "candumps", "candump-2018-09-03_200918.log"
+)
+
+
+def test_looped_timestamps_keep_increasing():
+    frames = len(list(read_candump(LOG)))
+    bus = CandumpBus(LOG, speed=0, loop=True)
+    try:
+        timestamps = [bus.recv(0).timestamp for _ in range(3 * frames)]
+    finally:
+        bus.shutdown()
+
+    assert all(b > a for a, b in zip(timestamps, timestamps[1:]))
+    # every pass is the log shifted by its span and one mean frame interval
+    span = timestamps[frames - 1] - timestamps[0]
+    shift = span + span / (frames - 1)
+    for i in range(frames):
+        assert abs(timestamps[frames + i] - timestamps[i] - shift) < 1e-6
+        assert abs(timestamps[2 * frames + i] - timestamps[i] - 2 * shift) < 1e-6
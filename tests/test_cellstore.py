@@ -0,0 +1,37 @@
+import random
+
+from cellstore import CellStore
+
+
+def test_cells_round_trip():
+    store = CellStore(modules=3, cellsPerModule=4)
+    assert len(store) == 12
+    store.set_cells(1, 0, (3301, 3302, 3303))
+    store.set_cells(1, 3, (3304,))
+    assert list(store.module(1)) == [3301, 3302, 3303, 3304]
+    assert list(store.module(0)) == [0, 0, 0, 0]
+    assert store.moduleSum[1] == 3301 + 3302 + 3303 + 3304
+    assert store.cell_id(7) == "M2C4"
+
+
+def test_sums_and_extremes_follow_updates():
+    rng = random.Random(2)
+    modules, cells = 8, 4
+    store = CellStore(modules, cells)
+    expected = [0] * (modules * cells)
+    for i in range(5000):
+        module = rng.randrange(modules)
+        first = rng.choice((0, 3))
+        values = [rng.randint(3000, 3700) for c in range(3 if first == 0 else 1)]
+        store.set_cells(module, first, values)
+        start = module * cells + first
+        expected[start : start + len(values)] = values
+
+        assert list(store.voltages) == expected
+        assert list(store.moduleSum) == [
+            sum(expected[m * cells : (m + 1) * cells]) for m in range(modules)
+        ]
+        assert store.maxValue == max(expected)
+        assert store.minValue == min(expected)
+        assert expected[store.maxIndex] == max(expected)
+        assert expected[store.minIndex] == min(expected)
@@ -0,0 +1,76 @@
+from dbuspublisher import DbusPublisher
+from fakedbus import FakeVeDbusService
+
+
+class UnbatchedService:
+    # a velib without ItemsChanged support, not usable as context manager
+    def __init__(self, servicename):
+        self._service = FakeVeDbusService(servicename)
+        self.add_path = self._service.add_path
+        self.signals = self._service.signals
+
+    def __getitem__(self, path):
+        return self._service[path]
+
+    def __setitem__(self, path, value):
+        self._service[path] = value
+
+
+def service(cls=FakeVeDbusService):
+    s = cls("com.victronenergy.battery.test")
+    for path in ("/Soc", "/Dc/0/Voltage", "/Dc/0/Current"):
+        s.add_path(path, None)
+    return s
+
+
+def test_changes_are_published_in_one_signal():
+    s = service()
+    publisher = DbusPublisher(s)
+    publisher["/Soc"] = 80
+    publisher["/Dc/0/Voltage"] = 27.1
+    assert s.signals == []
+
+    assert publisher.flush() == 2
+    assert [(name, items) for t, name, items in s.signals] == [
+        ("ItemsChanged", {"/Soc": 80, "/Dc/0/Voltage": 27.1})
+    ]
+
+
+def test_unchanged_values_are_not_published():
+    s = service()
+    publisher = DbusPublisher(s)
+    publisher.set_many(("/Soc", "/Dc/0/Voltage"), (80, 27.1))
+    publisher.flush()
+    del s.signals[:], s.assignments[:]
+
+    publisher.set_many(("/Soc", "/Dc/0/Voltage"), (80, 27.1))
+    publisher["/Dc/0/Current"] = 5
+    assert publisher.flush() == 1
+    assert [path for t, path, value in s.assignments] == ["/Dc/0/Current"]
+
+    publisher["/Soc"] = 80
+    assert publisher.flush() == 0
+    assert len(s.signals) == 1
+
+
+def test_return_to_published_value_drops_pending_change():
+    s = service()
+    publisher = DbusPublisher(s)
+    publisher["/Soc"] = 80
+    publisher.flush()
+
+    publisher["/Soc"] = 81
+    assert publisher["/Soc"] == 81
+    publisher["/Soc"] = 80
+    assert publisher["/Soc"] == 80
+    assert publisher.flush() == 0
+    assert len(s.signals) == 1
+
+
+def test_unbatched_service_is_published_item_by_item():
+    s = service(UnbatchedService)
+    publisher = DbusPublisher(s)
+    publisher["/Soc"] = 80
+    publisher["/Dc/0/Voltage"] = 27.1
+    assert publisher.flush() == 2
+    assert [name for t, name, items in s.signals] == ["PropertiesChanged"] * 2
@@ -0,0 +1,166 @@
+import glob
+import os
+import struct
+
+import pytest
+
+from canreplay import read_candump
+from ubmsbattery import TopologyDiscovery, UbmsBattery
+
+LOGS = sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), os.pardir, "candumps", "*.log"))
+)
+
+# values of BatterySnapshot compared against the reference decoder
+SCALARS = (
+    "soc",
+    "mode",
+    "voltage",
+    "current",
+    "chargeComplete",
+    "voltageAndCellTAlarms",
+    "internalErrors",
+    "currentAndPcbTAlarms",
+    "shutdownReason",
+    "maxPcbTemperature",
+    "maxCellTemperature",
+    "minCellTemperature",
+    "maxCellVoltage",
+    "minCellVoltage",
+    "maxChargeCurrent",
+    "maxDischargeCurrent",
+    "numberOfModulesBalancing",
+    "numberOfModulesCommunicating",
+)
+
+
+class ReferenceDecoder:
+    # the per frame parsing of the original decoder, one if/elif branch per arbitration ID,
+    # kept as executable specification of the frame layouts
+
+    def __init__(self, capacity, modules, modulesInSeries):
+        self.capacity = capacity
+        self.numberOfModules = modules
+        self.modulesInSeries = modulesInSeries
+        self.chargeComplete = 0
+        self.soc = self.mode = 0
+        self.voltage = self.current = 0
+        self.voltageAndCellTAlarms = self.internalErrors = 0
+        self.currentAndPcbTAlarms = self.shutdownReason = 0
+        self.maxPcbTemperature = self.maxCellTemperature = self.minCellTemperature = 0
+        self.cellVoltages = [(0, 0, 0, 0) for i in range(modules)]
+        self.moduleVoltage = [0] * modules
+        self.moduleCurrent = [0] * modules
+        self.moduleSoc = [0] * modules
+        self.moduleTemp = [0] * modules
+        self.maxCellVoltage = self.minCellVoltage = 3.2
+        self.maxChargeCurrent = self.maxDischargeCurrent = 5.0
+        self.numberOfModulesBalancing = self.numberOfModulesCommunicating = 0
+
+    def on_message_received(self, msg):
+        data = msg.data
+        if msg.arbitration_id == 0xC0:
+            self.soc = data[0]
+            self.mode = data[1]
+            self.voltageAndCellTAlarms = data[2]
+            self.internalErrors = data[3]
+            self.currentAndPcbTAlarms = data[4]
+            self.numberOfModulesCommunicating = data[5]
+            self.numberOfModulesBalancing = data[6]
+            self.shutdownReason = data[7]
+
+        elif msg.arbitration_id == 0xC1:
+            self.current = struct.unpack("Bb", data[0:2])[1]
+            if (self.mode & 0x2) != 0:
+                self.maxDischargeCurrent = int(struct.unpack("<h", data[3:5])[0] / 10)
+                self.maxChargeCurrent = int(
+                    struct.unpack("<h", bytearray([data[5], data[7]]))[0] / 10
+                )
+
+        elif msg.arbitration_id == 0xC2:
+            if (self.mode & 0x1) != 0:
+                self.chargeComplete = (data[3] & 0x4) >> 2
+                if (self.mode & 0x18) == 0x18:
+                    self.maxChargeCurrent = data[0]
+                else:
+                    self.maxChargeCurrent = self.capacity * 0.1
+
+        elif msg.arbitration_id == 0xC4:
+            self.maxCellTemperature = data[0] - 40
+            self.minCellTemperature = data[1] - 40
+            self.maxPcbTemperature = data[3] - 40
+            self.maxCellVoltage = struct.unpack("<h", data[4:6])[0] * 0.001
+            self.minCellVoltage = struct.unpack("<h", data[6:8])[0] * 0.001
+
+        elif msg.arbitration_id in range(0x350, 0x366, 2):
+            module = (msg.arbitration_id - 0x350) >> 1
+            self.cellVoltages[module] = struct.unpack(">hhh", data[2 : msg.dlc])
+
+        elif msg.arbitration_id in range(0x351, 0x366, 2):
+            module = (msg.arbitration_id - 0x351) >> 1
+            self.cellVoltages[module] = self.cellVoltages[module] + tuple(
+                struct.unpack(">h", data[2 : msg.dlc])
+            )
+            self.moduleVoltage[module] = sum(self.cellVoltages[module])
+            if module == self.numberOfModules - 1:
+                self.voltage = (
+                    sum(self.moduleVoltage[0 : self.modulesInSeries]) / 1000.0
+                )
+
+        elif msg.arbitration_id in (0x46A, 0x46B, 0x46C, 0x46D):
+            iStart = (msg.arbitration_id - 0x46A) * 3
+            fmt = ">" + "h" * int((msg.dlc - 2) / 2)
+            self.moduleCurrent[iStart:] = struct.unpack(fmt, data[2 : msg.dlc])
+
+        elif msg.arbitration_id in (0x6A, 0x6B):
+            iStart = (msg.arbitration_id - 0x6A) * 7
+            mSoc = struct.unpack("B" * (msg.dlc - 1), data[1 : msg.dlc])
+            self.moduleSoc[iStart:] = tuple((m * 100) >> 8 for m in mSoc)
+
+        elif msg.arbitration_id in (0x76A, 0x76B, 0x76C, 0x76D):
+            iStart = (msg.arbitration_id - 0x76A) * 3
+            self.moduleTemp[iStart] = ((data[2] * 256) + data[3]) * 0.01
+            if msg.dlc > 5:
+                self.moduleTemp[iStart + 1] = ((data[4] * 256) + data[5]) * 0.01
+            if msg.dlc > 7:
+                self.moduleTemp[iStart + 2] = ((data[6] * 256) + data[7]) * 0.01
+
+
+@pytest.mark.parametrize("log", LOGS, ids=os.path.basename)
+def test_decoder_matches_reference(log):
+    discovery = TopologyDiscovery()
+    for msg in read_candump(log):
+        discovery.add(msg.arbitration_id, msg.data)
+        if discovery.complete:
+            break
+    bat = UbmsBattery(
+        voltage=29.0,
+        capacity=650,
+        connection="test",
+        verify=False,
+        discovered=discovery.result(),
+    )
+    modules = bat.numberOfModules
+    reference = ReferenceDecoder(650, modules, bat.modulesInSeries)
+
+    snapshots = 0
+    for msg in read_candump(log):
+        if msg.is_extended_id or msg.is_remote_frame:
+            continue
+        reference.on_message_received(msg)
+        bat.decode(msg.timestamp, msg.arbitration_id, msg.data)
+        if msg.arbitration_id != 0xC0:
+            continue
+
+        # every status frame publishes a snapshot, compare it with the reference state
+        snapshots += 1
+        snap = bat.snapshot
+        for name in SCALARS:
+            assert getattr(snap, name) == pytest.approx(getattr(reference, name)), name
+        cells = [v for cells in reference.cellVoltages for v in cells[:4]]
+        assert list(snap.cellVoltages) == cells
+        assert list(snap.moduleVoltage) == reference.moduleVoltage
+        assert list(snap.moduleCurrent) == list(reference.moduleCurrent[:modules])
+        assert list(snap.moduleSoc) == list(reference.moduleSoc[:modules])
+        assert list(snap.moduleTemp) == pytest.approx(reference.moduleTemp)
+    assert snapshots == bat.snapshot.version > 0
@@ -0,0 +1,42 @@
+import pytest
+
+from energycounter import EnergyCounter
+
+
+def test_trapezoid():
+    counter = EnergyCounter()
+    counter.add(0.0, 26.0, 10.0)
+    counter.add(1.0, 26.0, 20.0)
+    # mean 15A for 1s
+    assert counter.chargedAh == pytest.approx(15.0 / 3600)
+    assert counter.chargedWh == pytest.approx(26.0 * 15.0 / 3600)
+    assert counter.dischargedAh == 0.0
+
+
+def test_discharge_is_summed_positive():
+    counter = EnergyCounter()
+    for t in range(11):
+        counter.add(float(t), 26.0, -36.0)
+    assert counter.dischargedAh == pytest.approx(0.1)
+    assert counter.dischargedWh == pytest.approx(2.6)
+    assert counter.chargedAh == 0.0
+
+
+def test_gap_longer_than_max_gap_is_not_integrated():
+    counter = EnergyCounter(maxGap=5.0)
+    counter.add(0.0, 26.0, 36.0)
+    counter.add(1.0, 26.0, 36.0)
+    charged = counter.chargedAh
+    # bus silent for 60s
+    counter.add(61.0, 26.0, 36.0)
+    assert counter.chargedAh == charged
+    # integration continues from the sample after the gap
+    counter.add(62.0, 26.0, 36.0)
+    assert counter.chargedAh == pytest.approx(2 * charged)
+
+
+def test_gap_of_max_gap_is_integrated():
+    counter = EnergyCounter(maxGap=5.0)
+    counter.add(0.0, 26.0, 36.0)
+    counter.add(5.0, 26.0, 36.0)
+    assert counter.chargedAh == pytest.approx(0.05)
@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+
+from canreplay import CandumpBus
+from identitycache import IdentityCache
+from ubmsbattery import UbmsBattery
+
+LOG = os.path.join(
+    os.path.dirname(__file__), os.pardir, "candumps", "candump-2018-08-24_103237.log"
+)
+
+
+def replay(cache, log=LOG):
+    # a battery that went through the whole log, verified or warm started from cache
+    bus = CandumpBus(log, speed=0)
+    bat = UbmsBattery(
+        voltage=29.0, capacity=650, connection="test", bus=bus, cache=cache
+    )
+    bus.finished.wait()
+    bat.shutdown()
+    return bat
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return IdentityCache(str(tmp_path / "ubms-test.json"))
+
+
+def test_warm_start_from_verified_identity(cache):
+    cold = replay(cache)
+    assert cold.verified is True
+    identity = cache.load()
+    assert identity["modules"] == 8 and identity["strings"] == 4
+
+    warm = replay(cache)
+    # published from the cache, then checked against the bus
+    assert warm.verified is True
+    assert warm.numberOfModules == 8
+    assert cache.load() == identity
+
+
+@pytest.mark.parametrize(
+    "content",
+    (
+        '{"firmwareVersion": 1}',
+        "[1, 2, 3]",
+        "not json",
+        json.dumps(
+            {
+                "firmwareVersion": 156,
+                "bms_type": 1,
+                "hw_rev": 38,
+                "modules": "8",
+                "strings": 4,
+                "cellsPerModule": 4,
+            }
+        ),
+        json.dumps(
+            {
+                "firmwareVersion": 156,
+                "bms_type": 1,
+                "hw_rev": 38,
+                "modules": 8,
+                "strings": 3,
+                "cellsPerModule": 4,
+            }
+        ),
+    ),
+)
+def test_malformed_cache_falls_back_to_verification(cache, content):
+    with open(cache.path, "w") as f:
+        f.write(content)
+    bat = replay(cache)
+    # a full verification ran and replaced the broken cache
+    assert bat.verified is True
+    assert bat.numberOfModules == 8
+    assert cache.load()["modules"] == 8
+
+
+def test_stale_identity_is_rejected(cache):
+    replay(cache)
+    identity = cache.load()
+    cache.save(dict(identity, firmwareVersion=identity["firmwareVersion"] + 1))
+    bat = replay(cache)
+    assert bat.verified is False
+    assert cache.load() is None
@@ -0,0 +1,95 @@
+import random
+
+from bisect import bisect_left, bisect_right
+from types import SimpleNamespace
+
+import pytest
+
+from telemetryfile import TelemetryFile, TelemetryWriter
+
+
+def snapshot(timestamp, i, modules=2, cells=4):
+    return SimpleNamespace(
+        timestamp=timestamp,
+        soc=i % 101,
+        mode=2,
+        voltage=26.5,
+        current=float(i % 50),
+        maxCellVoltage=3.3,
+        minCellVoltage=3.2,
+        maxCellTemperature=20.0,
+        minCellTemperature=19.0,
+        numberOfModulesBalancing=0,
+        shutdownReason=0,
+        moduleVoltage=[13.25] * modules,
+        moduleCurrent=[1.5] * modules,
+        moduleSoc=[50.0] * modules,
+        moduleTemp=[20.5 + m for m in range(modules)],
+        cellVoltages=[3300 + c + i % 7 for c in range(modules * cells)],
+    )
+
+
+@pytest.fixture
+def telemetry(tmp_path):
+    # repeated timestamps and gaps, a small interval so the index has many blocks
+    rng = random.Random(3)
+    times = []
+    t = 1e9
+    writer = TelemetryWriter(str(tmp_path / "pack.ubt"), 2, 4, interval=16)
+    for i in range(1000):
+        t += rng.choice((0.0, 0.55, 0.55, 30.0))
+        times.append(t)
+        writer.add(snapshot(t, i))
+    writer.close()
+    f = TelemetryFile(str(tmp_path / "pack.ubt"))
+    yield f, times
+    f.close()
+
+
+def test_range_query_matches_linear_scan(telemetry):
+    f, times = telemetry
+    rng = random.Random(4)
+    bounds = times[::37] + [times[0] - 1, times[-1] + 1]
+    bounds += [rng.uniform(times[0] - 10, times[-1] + 10) for i in range(200)]
+    for start in bounds:
+        for end in (start, start + 0.55, start + rng.uniform(0, 2000)):
+            rows = [i for i, t in enumerate(times) if start <= t <= end]
+            first, stop = f.rows_between(start, end)
+            assert list(range(first, stop)) == rows
+            assert (first, stop) == (
+                bisect_left(times, start),
+                max(bisect_left(times, start), bisect_right(times, end)),
+            )
+
+
+def test_columns_round_trip(telemetry):
+    f, times = telemetry
+    assert len(f) == len(times)
+    assert (f.start, f.end) == (times[0], times[-1])
+    assert list(f.column("time")) == times
+    assert list(f.column("current")) == [float(i % 50) for i in range(len(times))]
+    assert list(f.column("cellVoltage[7]")) == [3307 + i % 7 for i in range(len(times))]
+    assert set(f.column("moduleTemp[1]")) == {21.5}
+    start, end = times[100], times[200]
+    assert list(f.column("soc", start, end)) == [
+        i % 101 for i, t in enumerate(times) if start <= t <= end
+    ]
+
+
+def test_decreasing_timestamp_rejected(tmp_path):
+    writer = TelemetryWriter(str(tmp_path / "pack.ubt"), 2, 4)
+    writer.add(snapshot(10.0, 0))
+    with pytest.raises(ValueError):
+        writer.add(snapshot(9.0, 1))
+    writer.close()
+
+
+def test_numpy_views(telemetry):
+    numpy = pytest.importorskip("numpy")
+    f, times = telemetry
+    current = f.array("current", times[10], times[20])
+    assert not current.flags.owndata
+    assert numpy.array_equal(
+        current, numpy.array(f.column("current", times[10], times[20]))
+    )
+    del current
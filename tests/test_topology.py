@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from canreplay import CandumpBus, read_candump
+from ubmsbattery import DISCOVERY_CYCLES, MAX_MODULES, TopologyDiscovery, UbmsBattery
+
+LOG = os.path.join(
+    os.path.dirname(__file__), os.pardir, "candumps", "candump-2018-08-24_103237.log"
+)
+
+
+@pytest.fixture
+def flagged(tmp_path):
+    # the log of an 8 module pack whose status frames flag fewer modules than configured
+    path = tmp_path / "flagged.log"
+    with open(LOG) as log:
+        path.write_text(log.read().replace("0C0#350A00", "0C0#350A01"))
+    return str(path)
+
+
+def discover(path, cycles=None):
+    # feed a log until discovery completes or, if given, that many status frames were seen
+    discovery = TopologyDiscovery()
+    for msg in read_candump(path):
+        discovery.add(msg.arbitration_id, msg.data)
+        if discovery.cycles == cycles or cycles is None and discovery.complete:
+            break
+    return discovery
+
+
+def test_reported_modules_complete_after_two_cycles():
+    discovery = discover(LOG)
+    assert discovery.cycles == 2
+    assert discovery.result()[0] == 8
+    assert discovery.result()[2] == 4
+
+
+def test_flagged_modules_wait_for_all_groups(flagged):
+    discovery = discover(flagged)
+    assert discovery.cycles == DISCOVERY_CYCLES
+    assert discovery.result() == (None, 8, 4)
+
+
+def test_incomplete_discovery_assumes_largest_pack(flagged):
+    discovery = discover(flagged, cycles=3)
+    assert not discovery.complete
+    assert discovery.result()[:2] == (None, MAX_MODULES)
+
+
+def test_flagged_pack_is_verified_with_all_modules(flagged):
+    bus = CandumpBus(flagged, speed=0)
+    bat = UbmsBattery(voltage=29.0, capacity=650, connection="test", bus=bus)
+    bus.finished.wait()
+    bat.shutdown()
+    assert bat.numberOfModules == 8
+    assert bat.numberOfStrings == 4
+    assert bat.cellsPerModule == 4
+
+
+def test_uneven_strings_on_command_line_are_rejected():
+    with pytest.raises(ValueError):
+        UbmsBattery(
+            voltage=29.0,
+            capacity=650,
+            connection="test",
+            verify=False,
+            modules=8,
+            strings=3,
+        )
+
+
+def test_uneven_derived_strings_fall_back_to_one_string():
+    # 2 modules in series for 29V, 7 modules do not split into 3 strings
+    bat = UbmsBattery(
+        voltage=29.0, capacity=650, connection="test", verify=False, modules=7
+    )
+    assert bat.numberOfStrings == 1
+    assert bat.modulesInSeries == 7
@@ -9,7 +9,173 @@ The BMS should be operated in slave mode, VMU packages are being sent
 """
 import logging
 import can
+import socket
 import struct
+import time
+
+from itertools import chain
+
+from canbatch import BatchReceiver, RawFrameReader
+from canbatch import CAN_FRAME, CAN_FRAME_DATA, CAN_FRAME_HEADER
+from canfilters import can_filters
+from cellstore import CellStore
+from energycounter import EnergyCounter
+from instrumentation import DECODE_SAMPLE, DecodeStats
+from telemetry import TelemetryRing
+
+# precompiled frame layouts, see the decode handlers below
+# 0xC1: current, max discharge current, max charge current low and high byte
+_PACK = struct.Struct("<xbxhBxb")
+# 0xC2: max charge voltage
+_CHARGE = struct.Struct("<xh")
+# 0xC4: max/min cell temperature, max pcb temperature, max/min cell voltage
+_CELL_EXTREMES = struct.Struct("<BBxBhh")
+# 0x350 + 2n: cell voltages 1-3 of module n, 0x351 + 2n: cell voltage 4
+_CELLS_FIRST = struct.Struct(">2x3h")
+_CELLS_LAST = struct.Struct(">2xh")
+# 0x46A..0x46D: up to three module currents, indexed by frame length
+_MODULE_VALUES = {
+    dlc: struct.Struct(">2x%dh" % ((dlc - 2) >> 1)) for dlc in range(2, 9)
+}
+# 0x76A..0x76D: up to three module temperatures, indexed by frame length
+_MODULE_TEMPERATURES = {
+    dlc: struct.Struct(">2x%dH" % ((dlc - 2) >> 1)) for dlc in range(2, 9)
+}
+# frames needed to verify the BMS and discover the pack topology: status, pack, identity and the
+# cell voltages of up to 11 modules
+_VERIFY_IDS = (0xC0, 0xC1, 0x180) + tuple(range(0x350, 0x366))
+# a U-BMS handles up to 11 modules and sends the cell voltages of 3 of them per cycle, so all modules
+# were seen after the groups wrapped once: ceil(11 / 3) complete cycles, i.e. 5 status frames
+MAX_MODULES = 11
+MODULES_PER_CYCLE = 3
+DISCOVERY_CYCLES = -(-MAX_MODULES // MODULES_PER_CYCLE) + 1
+# 0x06A, 0x06B: module SOC scaled to 256
+_SOC_PERCENT = tuple((m * 100) >> 8 for m in range(256))
+
+
+class BatterySnapshot:
+    """
+    Read only copy of the decoded U-BMS state, taken by the decoder at the end of each complete
+    cycle of frames. Consumers on other threads read UbmsBattery.snapshot once and get consistent
+    pack and cell data without locking, version increments with every new snapshot.
+
+    """
+
+    _scalars = (
+        "soc",
+        "mode",
+        "state",
+        "voltage",
+        "current",
+        "chargeComplete",
+        "voltageAndCellTAlarms",
+        "internalErrors",
+        "currentAndPcbTAlarms",
+        "shutdownReason",
+        "maxPcbTemperature",
+        "maxCellTemperature",
+        "minCellTemperature",
+        "maxCellVoltage",
+        "minCellVoltage",
+        "maxChargeVoltage",
+        "maxChargeCurrent",
+        "maxDischargeCurrent",
+        "numberOfModules",
+        "numberOfModulesBalancing",
+        "numberOfModulesCommunicating",
+    )
+    __slots__ = _scalars + (
+        "version",
+        "timestamp",
+        "cellVoltages",
+        "maxCellIndex",
+        "minCellIndex",
+        "moduleVoltage",
+        "moduleCurrent",
+        "moduleSoc",
+        "moduleTemp",
+        "chargedAh",
+        "dischargedAh",
+        "chargedWh",
+        "dischargedWh",
+    )
+
+    def __init__(self, bat, version):
+        init = object.__setattr__
+        for name in self._scalars:
+            init(self, name, getattr(bat, name))
+        init(self, "version", version)
+        init(self, "timestamp", bat.updated)
+        init(self, "cellVoltages", tuple(bat.cells.voltages))
+        init(self, "maxCellIndex", bat.cells.maxIndex)
+        init(self, "minCellIndex", bat.cells.minIndex)
+        init(self, "moduleVoltage", tuple(bat.moduleVoltage))
+        init(self, "moduleCurrent", tuple(bat.moduleCurrent))
+        init(self, "moduleSoc", tuple(bat.moduleSoc))
+        init(self, "moduleTemp", tuple(bat.moduleTemp))
+        energy = bat.energy
+        init(self, "chargedAh", energy.chargedAh)
+        init(self, "dischargedAh", energy.dischargedAh)
+        init(self, "chargedWh", energy.chargedWh)
+        init(self, "dischargedWh", energy.dischargedWh)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BatterySnapshot is read only")
+
+
+class TopologyDiscovery:
+    """
+    Pack layout as seen in the frames of a U-BMS, fed frame by frame: by the verification on the bus and
+    by the offline analyzer, so both come to the same layout for the same frames.
+
+    """
+
+    def __init__(self):
+        self.cycles = 0
+        self.flagged = False
+        self.reported = None
+        self.highest = None
+        self.cells = None
+
+    def add(self, canId, data):
+        if canId == 0xC0 and len(data) >= 6:
+            # a cycle, with the cell voltages of 3 modules, lies between two status frames
+            self.cycles += 1
+            if data[2] & 1 == 0 and data[3] & 2 == 0:
+                self.reported = data[5]
+            else:
+                self.flagged = True
+        elif 0x350 <= canId < 0x366 and self.cycles:
+            module = (canId - 0x350) >> 1
+            if self.highest is None or module > self.highest:
+                self.highest = module
+            if canId & 1:
+                # 0x351 + 2n carries the cells after the first three
+                self.cells = min(4, 3 + ((len(data) - 2) >> 1))
+
+    @property
+    def complete(self):
+        # two status frames agreed on the number of modules or, when they flag missing or surplus
+        # modules, the cell voltage groups wrapped once
+        if self.flagged or self.reported is None:
+            return self.cycles >= DISCOVERY_CYCLES
+        return self.cycles >= 2
+
+    def result(self):
+        # the number of modules reported by the status frame (None if it flags missing or surplus
+        # modules), the modules sending cell voltages and the cells per module (3 or 4, None if
+        # not seen), see UbmsBattery._resolve_topology
+        reported = None if self.flagged else self.reported
+        seen = None if self.highest is None else self.highest + 1
+        if reported is None and self.cycles < DISCOVERY_CYCLES:
+            # not all module groups seen, size for the largest pack rather than dropping modules
+            logging.warning(
+                "Pack topology discovery incomplete after %d cycles, assuming %d modules",
+                self.cycles,
+                MAX_MODULES,
+            )
+            seen = MAX_MODULES
+        return reported, seen, self.cells
 
 
 class UbmsBattery(can.Listener):
@@ -17,6 +183,9 @@ class UbmsBattery(can.Listener):
 
     guiModeKey = {252: 0, 3: 2}
 
+    # module metrics kept in the telemetry history, in channel order after the cells
+    _TELEMETRY_MODULE = ("moduleVoltage", "moduleCurrent", "moduleSoc", "moduleTemp")
+
     opState = {0: 14, 1: 9, 2: 9}
     # Victron BMS states
     # 0-8 init
@@ -29,21 +198,34 @@ class UbmsBattery(can.Listener):
     #  16 pre-charge
     #  17 contactor check
 
-    def __init__(self, voltage, capacity, connection):
+    def __init__(
+        self,
+        voltage,
+        capacity,
+        connection,
+        bus=None,
+        threaded=True,
+        recorder=None,
+        cache=None,
+        modules=None,
+        strings=None,
+        cellsPerModule=None,
+        verify=True,
+        discovered=None,
+    ):
         self.capacity = capacity
         self.maxChargeVoltage = voltage
-        self.numberOfModules = 8
-        self.numberOfStrings = 2
-        self.modulesInSeries = int(self.numberOfModules / self.numberOfStrings)
-        self.cellsPerModule = 4
+        # pack layout given on the command line, anything left None is discovered from the bus
+        self._topology = (modules, strings, cellsPerModule)
         self.chargeComplete = 0
         self.soc = 0
         self.mode = 0
+        # mode sent to the BMS as VMU, drive until set_mode
+        self.commandedMode = 2
         self.state = ""
         self.voltage = 0
         self.current = 0
         self.temperature = 0
-        self.balanced = True
 
         self.voltageAndCellTAlarms = 0
         self.internalErrors = 0
@@ -53,11 +235,6 @@ class UbmsBattery(can.Listener):
         self.maxPcbTemperature = 0
         self.maxCellTemperature = 0
         self.minCellTemperature = 0
-        self.cellVoltages = [(0, 0, 0, 0) for i in range(self.numberOfModules)]
-        self.moduleVoltage = [0 for i in range(self.numberOfModules)]
-        self.moduleCurrent = [0 for i in range(self.numberOfModules)]
-        self.moduleSoc = [0 for i in range(self.numberOfModules)]
-        self.moduleTemp = [0 for i in range(self.numberOfModules)]
         self.maxCellVoltage = 3.2
         self.minCellVoltage = 3.2
         self.maxChargeCurrent = 5.0
@@ -69,85 +246,147 @@ class UbmsBattery(can.Listener):
         self.numberOfModulesBalancing = 0
         self.numberOfModulesCommunicating = 0
         self.updated = -1
+        # Ah and Wh totals since start, integrated from every 0xC1 frame
+        self.energy = EnergyCounter()
         self.cyclicModeTask = None
-
-        self._ci = can.interface.Bus(
-            channel=connection,
-            bustype="socketcan",
-            can_filters=[
-                {"can_id": 0x0CF, "can_mask": 0xFF0},  # BMS status
-                {"can_id": 0x180, "can_mask": 0xFFF},  # Firmware version and BMS type
-            ],
-        )
-
-        if self._connect_and_verify(connection):
-            # Now that we've confirmed connection, update filters for normal operation
+        self._notifier = None
+        self._reader = None
+        # optional flightrecorder.FlightRecorder receiving every frame
+        self.recorder = recorder
+        # called on the receiving thread after each new snapshot, e.g. to schedule a publish
+        self.onSnapshot = None
+        self._cache = cache
+        # None while a warm start is verified in the background, False if the BMS differs from the cache
+        self.verified = True
+
+        if not verify:
+            # decoder only, the owner feeds the frames, e.g. the offline analyzer, and may pass
+            # the result of a TopologyDiscovery
+            self._ci = bus
+            self._allocate(*self._resolve_topology(*(discovered or (None, None, None))))
             self._set_operational_filters()
-            
-            # Create the periodic message task
-            msg = can.Message(
-                arbitration_id=0x440, data=[0, 2, 0, 0], is_extended_id=False
-            )  # default: drive mode
-            self.cyclicModeTask = self._ci.send_periodic(msg, 1)
-        
-            # Set up the notifier for message callbacks
-            notifier = can.Notifier(self._ci, [self])
+            return
 
+        if bus is None:
+            self._ci = can.interface.Bus(channel=connection, bustype="socketcan")
+        else:
+            # an injected bus, e.g. a candump replay, see canreplay.py
+            self._ci = bus
+
+        identity = self._cached_identity()
+        if identity is not None:
+            # come up with the identity of the last run, the decoder checks it against the
+            # first identity frame and the first pack frame on the bus
+            logging.info(
+                "Warm start on %s as U-BMS type %d with firmware version %d",
+                connection,
+                identity["bms_type"],
+                identity["firmwareVersion"],
+            )
+            self.firmwareVersion = identity["firmwareVersion"]
+            self.bms_type = identity["bms_type"]
+            self.hw_rev = identity["hw_rev"]
+            self.verified = None
+            self._allocate(
+                identity["modules"], identity["strings"], identity["cellsPerModule"]
+            )
+            self._decoders[0x180] = self._decode_identity
+            self._decoders[0xC1] = self._verify_pack
+            self._pendingChecks = {0x180, 0xC1}
+            self._set_operational_filters()
+            self._start(threaded)
+            return
+
+        self._ci.set_filters(can_filters(_VERIFY_IDS))
+        connected, plausible, discovered = self._connect_and_verify(connection)
+        # all per module and per cell state is sized once, before any frame is decoded
+        self._allocate(*self._resolve_topology(*discovered))
+        self._set_operational_filters()
+
+        if connected:
+            if plausible and discovered[0] is not None:
+                self._save_identity()
+            else:
+                # a warm start could not tell this layout from a wrong one
+                logging.info("Identity not cached, status or pack voltage implausible")
+            self._start(threaded)
         else:
             logging.error("Failed to connect to a supported Valence U-BMS")
-    
-    def _connect_and_verify(self, connection):
-        # check connection, BMS type and that reported system voltage roughly matches configuration
-        found = 0
-        msg = None
 
-        while found != 7:
+    def _start(self, threaded):
+        # create a cyclic mode command message simulating a VMU master
+        # a U-BMS in slave mode according to manual section 6.4.1 switches to standby
+        # after 20 seconds of not receiving it
+        msg = can.Message(
+            arbitration_id=0x440, data=[0, 2, 0, 0], is_extended_id=False
+        )  # default: drive mode
+        self.cyclicModeTask = self._ci.send_periodic(msg, 1)
+
+        # on socketcan read raw frames in batches, other buses deliver can.Message objects
+        sock = getattr(self._ci, "socket", None)
+        if isinstance(sock, socket.socket):
+            self._reader = RawFrameReader(sock)
+
+        # Set up the notifier for message callbacks, without it the owner calls drain()
+        # whenever fileno() becomes readable
+        if threaded and self._reader is not None:
+            self._notifier = BatchReceiver(sock, self.drain)
+            self._notifier.start()
+        elif threaded:
+            self._notifier = can.Notifier(self._ci, [self])
+
+    def _connect_and_verify(self, connection, timeout=10.0):
+        # check connection, BMS type and that reported system voltage roughly matches configuration,
+        # and discover the pack topology, all in one pass over the bus with a single deadline.
+        # Returns whether the BMS was verified, whether the pack voltage was plausible and the
+        # discovered layout, see TopologyDiscovery.result
+        found = 0
+        plausible = True
+        discovery = TopologyDiscovery()
+        deadline = time.monotonic() + timeout
+
+        # done when status, pack and identity frame were seen and the layout is known, whatever the
+        # order the frames arrive in
+        while found != 7 or not discovery.complete:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                msg = self._ci.recv(timeout=10)
+                msg = self._ci.recv(timeout=remaining)
             except can.CanError:
                 logging.error("Canbus error")
+                continue
 
             if msg is None:
-                # timeout no system connected
-                logging.error(
-                    "No messages on canbus %s received. Check connection and speed setting."
-                    % connection
-                )
-                break
+                continue
+            canId = msg.arbitration_id
+            discovery.add(canId, msg.data)
 
-            elif msg.arbitration_id == 0xC0 and found & 2 == 0:
-                # status message received
-                logging.info(
-                    "Found Valence U-BMS on %s in mode %x with %i modules communicating.",
-                    connection,
-                    msg.data[1],
-                    msg.data[5],
-                )
-                if msg.data[2] & 1 != 0:
-                    logging.info(
-                        "The number of modules communicating is less than configured."
-                    )
-                if msg.data[3] & 2 != 0:
+            if canId == 0xC0:
+                if found & 2 == 0:
+                    # status message received
                     logging.info(
-                        "The number of modules communicating is higher than configured."
+                        "Found Valence U-BMS on %s in mode %x with %i modules communicating.",
+                        connection,
+                        msg.data[1],
+                        msg.data[5],
                     )
-
-                found = found | 2
-
-            elif msg.arbitration_id == 0xC1 and found & 1 == 0:
+                    if msg.data[2] & 1 != 0:
+                        logging.info(
+                            "The number of modules communicating is less than configured."
+                        )
+                    if msg.data[3] & 2 != 0:
+                        logging.info(
+                            "The number of modules communicating is higher than configured."
+                        )
+                    found = found | 2
+
+            elif canId == 0xC1 and found & 1 == 0:
                 # check pack voltage
-                if (
-                    abs(2 * msg.data[0] - self.maxChargeVoltage)
-                    > 0.15 * self.maxChargeVoltage
-                ):
-                    logging.error(
-                        "Pack voltage of %dV differs significantly from configured max charge voltage %dV.",
-                        msg.data[0],
-                        self.maxChargeVoltage,
-                    )
-                    found = found | 1
+                plausible = self._pack_voltage_plausible(msg.data)
+                found = found | 1
 
-            elif msg.arbitration_id == 0x180 and found & 4 == 0:
+            elif canId == 0x180 and found & 4 == 0:
                 self.firmwareVersion = msg.data[0]
                 # self.cust_rel_rev = msg.data[1]
                 # self.boot_load_rev = msg.data[2]
@@ -162,191 +401,457 @@ class UbmsBattery(can.Listener):
 
                 found = found | 4
 
-        if found == 7:
-
-            # msg = can.Message(arbitration_id=0x440, data=[0, self.opMode.get("Standby"), 0, 0], extended_id=False)
-
-            # create a cyclic mode command message simulating a VMU master
-            # a U-BMS in slave mode according to manual section 6.4.1 switches to standby
-            # after 20 seconds of not receiving it
-            msg = can.Message(
-                arbitration_id=0x440, data=[0, 2, 0, 0], is_extended_id=False
-            )  # default: drive mode
-
-            self.cyclicModeTask = self._ci.send_periodic(msg, 1)
-            notifier = can.Notifier(self._ci, [self])
-
-        return found == 7
+        if found == 0:
+            # timeout no system connected
+            logging.error(
+                "No messages on canbus %s received. Check connection and speed setting."
+                % connection
+            )
+        elif found != 7:
+            logging.error("U-BMS on %s not verified within %gs", connection, timeout)
+
+        return found == 7, plausible, discovery.result()
+
+    def _pack_voltage_plausible(self, data):
+        # the pack voltage of a 0xC1 frame roughly matches the configured max charge voltage
+        if abs(2 * data[0] - self.maxChargeVoltage) <= 0.15 * self.maxChargeVoltage:
+            return True
+        logging.error(
+            "Pack voltage of %dV differs significantly from configured max charge voltage %dV.",
+            2 * data[0],
+            self.maxChargeVoltage,
+        )
+        return False
+
+    def _identity(self):
+        return {
+            "firmwareVersion": self.firmwareVersion,
+            "bms_type": self.bms_type,
+            "hw_rev": self.hw_rev,
+            "modules": self.numberOfModules,
+            "strings": self.numberOfStrings,
+            "cellsPerModule": self.cellsPerModule,
+        }
+
+    def _cached_identity(self):
+        # the identity of the last verified run, unless the command line asks for another layout
+        if self._cache is None:
+            return None
+        identity = self._cache.load()
+        if identity is None:
+            return None
+        for name, value in zip(("modules", "strings", "cellsPerModule"), self._topology):
+            if value is not None and identity.get(name) != value:
+                logging.info("Cached %s differs from the command line, verifying", name)
+                return None
+        return identity
+
+    def _save_identity(self):
+        if self._cache is not None:
+            self._cache.save(self._identity())
+
+    def _resolve_topology(self, reported, seen, cells):
+        # command line values first, then what was discovered, then the largest pack a U-BMS handles
+        modules, strings, cellsPerModule = self._topology
+        if modules is None:
+            modules = reported or seen or MAX_MODULES
+        if cellsPerModule is None:
+            cellsPerModule = cells or 4
+        if strings is None:
+            # modules in series needed for the charge voltage at 3.6V per LFP cell
+            inSeries = min(
+                modules, max(1, round(self.maxChargeVoltage / (cellsPerModule * 3.6)))
+            )
+            strings = max(1, modules // inSeries)
+            if modules % strings:
+                # cell voltages are summed per string, an uneven split would be summed wrongly
+                logging.warning(
+                    "%d modules do not split into %d equal strings, assuming one string",
+                    modules,
+                    strings,
+                )
+                strings = 1
+        elif modules % strings:
+            raise ValueError(
+                "%d modules do not split into %d equal strings" % (modules, strings)
+            )
+        logging.info(
+            "Pack of %d modules in %d strings, %d cells per module",
+            modules,
+            strings,
+            cellsPerModule,
+        )
+        return modules, strings, cellsPerModule
+
+    def _allocate(self, modules, strings, cellsPerModule):
+        # size all per module and per cell state once for the pack layout
+        self.numberOfModules = modules
+        self.numberOfStrings = strings
+        self.modulesInSeries = modules // strings
+        self.cellsPerModule = cellsPerModule
+        self.cells = CellStore(modules, cellsPerModule)
+        self.moduleVoltage = self.cells.moduleSum
+        self.moduleCurrent = [0] * modules
+        self.moduleSoc = [0] * modules
+        self.moduleTemp = [0] * modules
+        self._decoders = self._build_decoders()
+        # hot path counters, published by the dbus service under /Debug
+        self.stats = DecodeStats(sorted(self._decoders))
+        self.snapshot = BatterySnapshot(self, 0)
+        # history of cell voltages followed by module voltages, currents, SOC and temperatures
+        self.telemetry = TelemetryRing(
+            len(self.cells) + len(self._TELEMETRY_MODULE) * modules
+        )
 
     def _set_operational_filters(self):
-        # Set up filters for the messages we want to receive
-        filters = [
-            {"can_id": 0x0CF, "can_mask": 0xFF0},  
-            {"can_id": 0x350, "can_mask": 0xFF0},
-            {"can_id": 0x360, "can_mask": 0xFF0},
-            {"can_id": 0x46A, "can_mask": 0xFF0},
-            {"can_id": 0x06A, "can_mask": 0xFF0},
-            {"can_id": 0x76A, "can_mask": 0xFF0},  
-        ]
+        # let the kernel pass exactly the frames the decoder uses in the current mode
+        ids = set(self._decoders)
+        self._chargeFrames = self.commandedMode == 1 or self.mode & 1 != 0
+        if not self._chargeFrames:
+            # 0xC2 is only decoded in charge mode
+            ids.discard(0xC2)
+        if self._ci is None:
+            return
+        filters = can_filters(ids)
+        logging.debug(
+            "CAN filters %s",
+            ", ".join("%03X/%03X" % (f["can_id"], f["can_mask"]) for f in filters),
+        )
         self._ci.set_filters(filters)
 
+    def _build_decoders(self):
+        # map every arbitration ID the decoder understands to its handler, so
+        # dispatch is a single dict lookup per frame
+        decoders = {
+            0xC0: self._decode_status,
+            0xC1: self._decode_pack,
+            0xC2: self._decode_charge,
+            0xC4: self._decode_cell_extremes,
+        }
+        # module frames only for the modules of this pack, frames of others are ignored
+        modules = self.numberOfModules
+        for canId in range(0x350, 0x350 + 2 * modules, 2):
+            decoders[canId] = self._decode_cells_first
+            decoders[canId + 1] = self._decode_cells_last
+        for canId in range(0x46A, 0x46A + (modules + 2) // 3):
+            decoders[canId] = self._decode_module_currents
+        for canId in range(0x06A, 0x06A + (modules + 6) // 7):
+            decoders[canId] = self._decode_module_soc
+        for canId in range(0x76A, 0x76A + (modules + 2) // 3):
+            decoders[canId] = self._decode_module_temperatures
+        return decoders
+
     def on_message_received(self, msg):
         self.updated = msg.timestamp
-        if msg.arbitration_id == 0xC0:
-            self.soc = msg.data[0]
-            self.mode = msg.data[1]
-            self.state = self.opState[self.mode & 0x3]
-            self.voltageAndCellTAlarms = msg.data[2]
-            self.internalErrors = msg.data[3]
-            self.currentAndPcbTAlarms = msg.data[4]
-
-            self.numberOfModulesCommunicating = msg.data[5]
-
-            # if no module flagged missing and not too many on the bus, then this is the number the U-BMS was configured for
-            if (msg.data[2] & 1 == 0) and (msg.data[3] & 2 == 0):
-                self.numberOfModules = self.numberOfModulesCommunicating
-
-            self.numberOfModulesBalancing = msg.data[6]
-
-            if (self.shutdownReason == 0 and msg.data[7] != 0) or self.shutdownReason != msg.data[7]:
-                logging.warning("Shutdown reason 0x%x", msg.data[7])
-            
-                logging.debug(
-                    "SOC %d%% mode %d state %s alarms 0x%x 0x%x 0x%x",
-                    self.soc,
-                    self.mode,
-                    self.state,
-                    self.voltageAndCellTAlarms,
-                    self.internalErrors,
-                    self.currentAndPcbTAlarms,
-                )
+        if self.recorder is not None:
+            self.recorder.record(msg)
+        stats = self.stats
+        canId = msg.arbitration_id
+        handler = self._decoders.get(canId)
+        if handler is None:
+            stats.unknown += 1
+            return
+        frames = stats.frames
+        count = frames[canId] + 1
+        frames[canId] = count
+        stats.lastSeen[canId] = msg.timestamp
+        stats.octets += msg.dlc
+        if count & (DECODE_SAMPLE - 1):
+            handler(canId, msg.data)
+        else:
+            start = time.perf_counter_ns()
+            handler(canId, msg.data)
+            stats.decode.add(time.perf_counter_ns() - start)
+
+    def decode(self, timestamp, canId, data):
+        # one frame given as values, e.g. parsed from a log, without counting it in the stats
+        self.updated = timestamp
+        handler = self._decoders.get(canId)
+        if handler is not None:
+            handler(canId, data)
+
+    def on_frames(self, buffer, count, timestamp):
+        # decode count raw can_frame structs from buffer, all received at timestamp
+        self.updated = timestamp
+        if self.recorder is not None:
+            self.recorder.record_frames(buffer, count, timestamp)
+        stats = self.stats
+        begin = time.perf_counter_ns()
+        frames = stats.frames
+        lastSeen = stats.lastSeen
+        unknown = octets = 0
+        decoders = self._decoders
+        view = memoryview(buffer)
+        for offset in range(0, count * CAN_FRAME.size, CAN_FRAME.size):
+            # extended, remote and error frames carry flags in the ID and never match
+            canId, dlc = CAN_FRAME_HEADER.unpack_from(buffer, offset)
+            handler = decoders.get(canId)
+            if handler is not None:
+                frames[canId] += 1
+                lastSeen[canId] = timestamp
+                octets += dlc
+                start = offset + CAN_FRAME_DATA
+                handler(canId, view[start : start + dlc])
+            else:
+                unknown += 1
+        stats.unknown += unknown
+        stats.octets += octets
+        stats.batch(count)
+        stats.decode.add((time.perf_counter_ns() - begin) // count)
+
+    def _decode_status(self, canId, data):
+        self.soc = data[0]
+        self.mode = data[1]
+        if (self.mode & 1 != 0) != self._chargeFrames and self.commandedMode != 1:
+            # the BMS entered or left charge mode on its own
+            self._set_operational_filters()
+        self.state = self.opState[self.mode & 0x3]
+        self.voltageAndCellTAlarms = data[2]
+        self.internalErrors = data[3]
+        self.currentAndPcbTAlarms = data[4]
 
-            self.shutdownReason = msg.data[7]
+        self.numberOfModulesCommunicating = data[5]
+        self.numberOfModulesBalancing = data[6]
 
-        elif msg.arbitration_id == 0xC1:
-            #            self.voltage = msg.data[0] * 1 # voltage scale factor depends on BMS configuration!
-            self.current = struct.unpack("Bb", msg.data[0:2])[1]
+        shutdownReason = data[7]
+        if (self.shutdownReason == 0 and shutdownReason != 0) or (
+            self.shutdownReason != shutdownReason
+        ):
+            logging.warning("Shutdown reason 0x%x", shutdownReason)
 
-            if (self.mode & 0x2) != 0:  # provided in drive mode only
-                self.maxDischargeCurrent = int(
-                    (struct.unpack("<h", msg.data[3:5])[0]) / 10
-                )
-                self.maxChargeCurrent = int(
-                    (struct.unpack("<h", bytearray([msg.data[5], msg.data[7]]))[0]) / 10
-                )
-                logging.debug(
-                    "Icmax %dA Idmax %dA",
-                    self.maxChargeCurrent,
-                    self.maxDischargeCurrent,
-                )
-
-            logging.debug("I: %dA U: %dV", self.current, msg.data[0])
-
-        elif msg.arbitration_id == 0xC2:
-            # charge mode only
-            if (self.mode & 0x1) != 0:
-                self.chargeComplete = (msg.data[3] & 0x4) >> 2
-                self.maxChargeVoltage2 = struct.unpack("<h", msg.data[1:3])[0]
-
-                # only apply lower charge current when equalizing
-                if (self.mode & 0x18) == 0x18:
-                    self.maxChargeCurrent = msg.data[0]
-                else:
-                    # allow charge with 0.1C
-                    self.maxChargeCurrent = self.capacity * 0.1
-
-        elif msg.arbitration_id == 0xC4:
-            self.maxCellTemperature = msg.data[0] - 40
-            self.minCellTemperature = msg.data[1] - 40
-            self.maxPcbTemperature = msg.data[3] - 40
-            self.maxCellVoltage = struct.unpack("<h", msg.data[4:6])[0] * 0.001
-            self.minCellVoltage = struct.unpack("<h", msg.data[6:8])[0] * 0.001
             logging.debug(
-                "Umin %1.3fV Umax %1.3fV", self.minCellVoltage, self.maxCellVoltage
+                "SOC %d%% mode %d state %s alarms 0x%x 0x%x 0x%x",
+                self.soc,
+                self.mode,
+                self.state,
+                self.voltageAndCellTAlarms,
+                self.internalErrors,
+                self.currentAndPcbTAlarms,
             )
 
-        elif msg.arbitration_id in [
-            0x350,
-            0x352,
-            0x354,
-            0x356,
-            0x358,
-            0x35A,
-            0x35C,
-            0x35E,
-            0x360,
-            0x362,
-            0x364,
-        ]:
-            module = (msg.arbitration_id - 0x350) >> 1
-            self.cellVoltages[module] = struct.unpack(">hhh", msg.data[2 : msg.dlc])
-
-        elif msg.arbitration_id in [
-            0x351,
-            0x353,
-            0x355,
-            0x357,
-            0x359,
-            0x35B,
-            0x35D,
-            0x35F,
-            0x361,
-            0x363,
-            0x365,
-        ]:
-            module = (msg.arbitration_id - 0x351) >> 1
-            self.cellVoltages[module] = self.cellVoltages[module] + tuple(
-                struct.unpack(">h", msg.data[2 : msg.dlc])
+        self.shutdownReason = shutdownReason
+
+        # the status frame closes a cycle, publish the state collected so far in one piece
+        self.snapshot = BatterySnapshot(self, self.snapshot.version + 1)
+        if self.onSnapshot is not None:
+            self.onSnapshot()
+
+    def _decode_identity(self, canId, data):
+        # only during a warm start, compare the first identity frame with the cached identity
+        if not self.snapshot.version:
+            # wait for a status frame with the number of modules to compare
+            return
+        del self._decoders[0x180]
+        self._set_operational_filters()
+        if self.voltageAndCellTAlarms & 1 or self.internalErrors & 2:
+            # missing or surplus modules, the cached layout cannot be checked
+            self._reject_identity("the status frame flags missing or surplus modules")
+            return
+        expected = self._identity()
+        actual = dict(
+            expected,
+            firmwareVersion=data[0],
+            bms_type=data[3],
+            hw_rev=data[4],
+            modules=self.numberOfModulesCommunicating,
+        )
+        if actual != expected:
+            self._reject_identity("identity on the bus is %s" % actual)
+            return
+        self._passed_check(canId)
+
+    def _verify_pack(self, canId, data):
+        # only during a warm start, check the first pack frame as a full verification does
+        self._decoders[0xC1] = self._decode_pack
+        if self._pack_voltage_plausible(data):
+            self._passed_check(canId)
+        else:
+            self._reject_identity("the pack voltage does not match the configuration")
+        self._decode_pack(canId, data)
+
+    def _passed_check(self, canId):
+        self._pendingChecks.discard(canId)
+        if not self._pendingChecks and self.verified is None:
+            logging.info("U-BMS identity verified")
+            self.verified = True
+
+    def _reject_identity(self, reason):
+        if self.verified is False:
+            return
+        logging.error("U-BMS not verified against the cached identity, %s", reason)
+        # the next start verifies and discovers again
+        self._cache.clear()
+        self.verified = False
+
+    def _decode_pack(self, canId, data):
+        #            self.voltage = data[0] * 1 # voltage scale factor depends on BMS configuration!
+        current, maxDischargeCurrent, chargeLow, chargeHigh = _PACK.unpack_from(data)
+        self.current = current
+        self.energy.add(self.updated, self.voltage, current)
+
+        if (self.mode & 0x2) != 0:  # provided in drive mode only
+            self.maxDischargeCurrent = int(maxDischargeCurrent / 10)
+            self.maxChargeCurrent = int(((chargeHigh << 8) | chargeLow) / 10)
+            logging.debug(
+                "Icmax %dA Idmax %dA",
+                self.maxChargeCurrent,
+                self.maxDischargeCurrent,
             )
-            self.moduleVoltage[module] = sum(self.cellVoltages[module])
-            logging.debug("Umodule %d: %fmV", module, self.moduleVoltage[module])
 
-            # update pack voltage at each arrival of the last modules cell voltages
-            if module == self.numberOfModules - 1:
-                self.voltage = (
-                    sum(self.moduleVoltage[0 : self.modulesInSeries]) / 1000.0
-                )
+        logging.debug("I: %dA U: %dV", self.current, data[0])
+
+    def _decode_charge(self, canId, data):
+        # charge mode only
+        if (self.mode & 0x1) != 0:
+            self.chargeComplete = (data[3] & 0x4) >> 2
+            self.maxChargeVoltage2 = _CHARGE.unpack_from(data)[0]
+
+            # only apply lower charge current when equalizing
+            if (self.mode & 0x18) == 0x18:
+                self.maxChargeCurrent = data[0]
+            else:
+                # allow charge with 0.1C
+                self.maxChargeCurrent = self.capacity * 0.1
+
+    def _decode_cell_extremes(self, canId, data):
+        maxCellT, minCellT, maxPcbT, maxCellV, minCellV = _CELL_EXTREMES.unpack_from(
+            data
+        )
+        self.maxCellTemperature = maxCellT - 40
+        self.minCellTemperature = minCellT - 40
+        self.maxPcbTemperature = maxPcbT - 40
+        self.maxCellVoltage = maxCellV * 0.001
+        self.minCellVoltage = minCellV * 0.001
+        logging.debug(
+            "Umin %1.3fV Umax %1.3fV", self.minCellVoltage, self.maxCellVoltage
+        )
+
+    def _decode_cells_first(self, canId, data):
+        self.cells.set_cells((canId - 0x350) >> 1, 0, _CELLS_FIRST.unpack_from(data))
 
-        elif msg.arbitration_id in [0x46A, 0x46B, 0x46C, 0x46D]:
-            iStart = (msg.arbitration_id - 0x46A) * 3
-            fmt = ">" + "h" * int((msg.dlc - 2) / 2)
-            mCurrent = struct.unpack(fmt, msg.data[2 : msg.dlc])
-            self.moduleCurrent[iStart:] = mCurrent
-            # logging.debug("Imodule %s", ",".join(str(x) for x in self.moduleCurrent))
-
-        elif msg.arbitration_id in [0x6A, 0x6B]:
-            iStart = (msg.arbitration_id - 0x6A) * 7
-            fmt = "B" * (msg.dlc - 1)
-            mSoc = struct.unpack(fmt, msg.data[1 : msg.dlc])
-            self.moduleSoc[iStart:] = tuple((m * 100) >> 8 for m in mSoc)
-            # logging.debug("SOCmodule %s", ",".join(str(x) for x in self.moduleSoc))
-
-        elif msg.arbitration_id in [0x76A, 0x76B, 0x76C, 0x76D]:
-            iStart = (msg.arbitration_id - 0x76A) * 3
-            self.moduleTemp[iStart] = ((msg.data[2] * 256) + msg.data[3]) * 0.01
-            if msg.dlc > 5: 
-                self.moduleTemp[iStart + 1] = ((msg.data[4] * 256) + msg.data[5]) * 0.01
-            if msg.dlc > 7: 
-                self.moduleTemp[iStart + 2] = ((msg.data[6] * 256) + msg.data[7]) * 0.01
-            # logging.debug("Tmodule %s", ",".join(str(x) for x in self.moduleTemp))   
+    def _decode_cells_last(self, canId, data):
+        module = (canId - 0x351) >> 1
+        self.cells.set_cells(
+            module, 3, _CELLS_LAST.unpack_from(data)[: self.cellsPerModule - 3]
+        )
+        logging.debug("Umodule %d: %fmV", module, self.moduleVoltage[module])
+
+        # update pack voltage at each arrival of the last modules cell voltages
+        if module == self.numberOfModules - 1:
+            self.voltage = sum(self.moduleVoltage[0 : self.modulesInSeries]) / 1000.0
+
+    def _decode_module_currents(self, canId, data):
+        iStart = (canId - 0x46A) * 3
+        # never past the last module, the slice assignment would grow the list
+        mCurrent = _MODULE_VALUES[len(data)].unpack_from(data)[
+            : self.numberOfModules - iStart
+        ]
+        self.moduleCurrent[iStart : iStart + len(mCurrent)] = mCurrent
+        # logging.debug("Imodule %s", ",".join(str(x) for x in self.moduleCurrent))
+
+    def _decode_module_soc(self, canId, data):
+        iStart = (canId - 0x6A) * 7
+        mSoc = [_SOC_PERCENT[m] for m in data[1 : 1 + self.numberOfModules - iStart]]
+        self.moduleSoc[iStart : iStart + len(mSoc)] = mSoc
+        # logging.debug("SOCmodule %s", ",".join(str(x) for x in self.moduleSoc))
+
+    def _decode_module_temperatures(self, canId, data):
+        iStart = (canId - 0x76A) * 3
+        mTemp = _MODULE_TEMPERATURES[len(data)].unpack_from(data)[
+            : self.numberOfModules - iStart
+        ]
+        for i, t in enumerate(mTemp, iStart):
+            self.moduleTemp[i] = t * 0.01
+        # logging.debug("Tmodule %s", ",".join(str(x) for x in self.moduleTemp))
+
+    def stale_modules(self, maxAge=10.0):
+        # modules whose cell voltage frames are more than maxAge s older than the newest frame
+        lastSeen = self.stats.lastSeen
+        oldest = self.updated - maxAge
+        return [
+            module
+            for module in range(self.numberOfModules)
+            if max(lastSeen[0x350 + 2 * module], lastSeen[0x351 + 2 * module]) < oldest
+        ]
+
+    def record_history(self, snap):
+        # add a snapshot to the telemetry history, called by the consumer (the dbus update tick)
+        # rather than on the receiving thread
+        self.telemetry.add(
+            snap.timestamp,
+            chain(
+                snap.cellVoltages,
+                snap.moduleVoltage,
+                snap.moduleCurrent,
+                snap.moduleSoc,
+                snap.moduleTemp,
+            ),
+        )
+
+    def history(self, metric, module, cell=None, start=0, end=float("inf"), step=None):
+        """
+        Recorded values of one module metric (see _TELEMETRY_MODULE) or, with metric "cellVoltage",
+        of one cell as list of (timestamp, value), averaged per bucket. Units as decoded:
+        mV, A, %, degC. See TelemetryRing.query for start, end and step.
+
+        """
+        if metric == "cellVoltage":
+            channel = module * self.cells.cellsPerModule + cell
+        else:
+            channel = (
+                len(self.cells)
+                + self._TELEMETRY_MODULE.index(metric) * self.cells.modules
+                + module
+            )
+        return self.telemetry.query(channel, start, end, step)
+
+    def fileno(self):
+        # file descriptor of the CAN socket, raises NotImplementedError for buses without one
+        return self._ci.fileno()
+
+    def drain(self, limit=64):
+        # decode the frames waiting on the bus on the calling thread, returns the number of frames
+        if self._reader is not None:
+            count = self._reader.read()
+            if count:
+                self.on_frames(self._reader.buffer, count, time.time())
+            return count
+
+        recv = self._ci.recv
+        for count in range(limit):
+            msg = recv(timeout=0)
+            if msg is None:
+                return count
+            self.on_message_received(msg)
+        return limit
+
+    def shutdown(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+        if self._ci is not None:
+            self._ci.shutdown()
 
     # change operational mode of the BMS, valid values see opModes (accepting strings and numbers)
     # transition between charge and drive only via standby(1-0-2)
     def set_mode(self, mode):
 
-        if not mode in [0, 1, 2]:
-            logging.warning("Invalid mode requested %s " % str(value))
+        if mode not in [0, 1, 2]:
+            logging.warning("Invalid mode requested %s " % str(mode))
             return False
- 
-        if not isinstance(self.cyclicModeTask, can.ModifiableCyclicTaskABC):
-            msg = can.Message(arbitration_id=0x440, data=[0, mode, 0, 0], extended_id=False)
-            self.cyclicModeTask.modify(msg)
-            
+
+        msg = can.Message(
+            arbitration_id=0x440, data=[0, mode, 0, 0], is_extended_id=False
+        )
+        if isinstance(self.cyclicModeTask, can.ModifiableCyclicTaskABC):
+            self.cyclicModeTask.modify_data(msg)
         else:
-            self.cyclicModeTask.stop()
-            msg = can.Message(arbitration_id=0x440, data=[0, mode, 0, 0], extended_id=False)
+            if self.cyclicModeTask is not None:
+                self.cyclicModeTask.stop()
             self.cyclicModeTask = self._ci.send_periodic(msg, 1)
 
+        self.commandedMode = mode
+        self._set_operational_filters()
+
         logging.info("Changed mode to %s" % self.opModes[mode])
         return True
 
@@ -356,15 +861,9 @@ def main():
 
     #       logger = can.Logger('logfile.asc')
 
+    # the battery runs its own notifier
     bat = UbmsBattery(capacity=650, voltage=29.0, connection="can0")
 
-    listeners = [
-        #               logger,          # Regular Listener object
-        bat
-    ]
-
-    notifier = can.Notifier(bat._ci, listeners)
-    
     # print out some info about the BMS
     logging.info("BMS type: %d", bat.bms_type)
     logging.info("Firmware version: %d", bat.firmwareVersion)
@@ -376,11 +875,10 @@ def main():
     logging.info("Min cell voltage: %1.3fV", bat.minCellVoltage)
     logging.info("Cell voltages:")
     for i in range(bat.numberOfModules):
-        logging.info("Module %d: %s", i, bat.cellVoltages[i])  
+        logging.info("Module %d: %s", i, bat.cells.module(i).tolist())  
 
     # Clean-up
-    notifier.stop()
-    bat._ci.shutdown()
+    bat.shutdown()
 
     logging.basicConfig(format="%(levelname)-8s %(message)s", level=(logging.DEBUG))
 
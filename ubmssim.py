@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+"""
+Simulator of a Valence U-BMS in slave mode, as load generator and test peer for the driver.
+It sends the frames of a configurable pack (up to 11 modules) in the order of a real BMS: every cycle the
+cell voltages of the next three modules, one group of module currents, SOC or temperatures, then 0xC4,
+0xC1, 0xC0 and 0xC2, and every sixth cycle the identity frame 0x180. It follows the mode commands 0x440
+of the VMU and falls back to standby 20s after the last one.
+
+Either as in-process bus, e.g. UbmsBattery(..., bus=SimulatedBus(modules=11, speed=10)), or on a
+(v)can interface:
+
+ python3 ubmssim.py -i vcan0 -m 11 -s 10
+
+"""
+
+import logging
+import random
+import struct
+import threading
+import time
+
+from argparse import ArgumentParser
+
+import can
+
+# seconds between two status frames of a real BMS
+CYCLE = 0.55
+# cycles between two identity frames
+IDENTITY_CYCLES = 6
+# the BMS switches to standby without mode command for this long, manual section 6.4.1
+SLAVE_TIMEOUT = 20
+# mode bits of the status frame
+MODE_CHARGE = 0x1
+MODE_DRIVE = 0x2
+MODE_SLAVE = 0x8
+
+_PACK = struct.Struct("<BbxhBxb")
+_CHARGE = struct.Struct("<BhBx")
+_CELL_EXTREMES = struct.Struct("<BBxBhh")
+_CELLS_FIRST = struct.Struct(">BB3h")
+_CELLS_LAST = struct.Struct(">BBh")
+
+
+class UbmsSimulator:
+    def __init__(
+        self,
+        modules=8,
+        strings=None,
+        cellsPerModule=4,
+        capacity=650,
+        soc=50.0,
+        current=-20.0,
+        seed=None,
+    ):
+        if not 1 <= modules <= 11:
+            raise ValueError("a U-BMS handles 1 to 11 modules, not %d" % modules)
+        if strings is None:
+            # two modules in series where they pair up, as the original 29V pack, else one per string
+            strings = modules // 2 if modules % 2 == 0 else modules
+        if modules % strings:
+            raise ValueError(
+                "%d modules do not split into %d equal strings" % (modules, strings)
+            )
+        self.modules = modules
+        self.strings = strings
+        self.modulesInSeries = modules // strings
+        self.cellsPerModule = cellsPerModule
+        self.capacity = capacity
+        self.soc = soc
+        # pack current in A, negative when discharging
+        self.current = current
+        self.mode = MODE_SLAVE
+        self.lastCommand = None
+        self.cycle = 0
+        self._random = random.Random(seed)
+        # fixed offset of each cell from the pack average in mV
+        self._offsets = [
+            self._random.randint(-8, 8) for i in range(modules * cellsPerModule)
+        ]
+        self.cells = [0] * (modules * cellsPerModule)
+        self._update_cells()
+
+    def _update_cells(self):
+        base = 3200 + int(self.soc * 1.5) + int(self.current * 0.5)
+        noise = self._random.randint
+        self.cells = [base + offset + noise(-2, 2) for offset in self._offsets]
+
+    def command(self, msg, now):
+        # a mode command of the VMU, now on the clock used for the slave timeout
+        if msg.arbitration_id != 0x440 or len(msg.data) < 2:
+            return
+        mode = msg.data[1]
+        if mode in (0, MODE_CHARGE, MODE_DRIVE):
+            if mode | MODE_SLAVE != self.mode:
+                logging.info("Simulated U-BMS switches to mode %d", mode)
+            self.mode = mode | MODE_SLAVE
+            self.lastCommand = now
+
+    def _step(self, now, dt):
+        if (
+            self.mode != MODE_SLAVE
+            and self.lastCommand is not None
+            and now - self.lastCommand > SLAVE_TIMEOUT
+        ):
+            logging.info("Simulated U-BMS without mode command, standby")
+            self.mode = MODE_SLAVE
+        current = self.current if self.mode != MODE_SLAVE else 0.0
+        self.soc = min(100.0, max(0.0, self.soc + current * dt / 36.0 / self.capacity))
+        self._update_cells()
+
+    def frames(self, now, dt=CYCLE):
+        # the frames of one cycle as (arbitration ID, data), the status frame closes the cycle,
+        # dt is the simulated time since the last cycle
+        self._step(now, dt)
+        cycle = self.cycle
+        self.cycle += 1
+        cells = self.cellsPerModule
+        current = int(self.current) if self.mode != MODE_SLAVE else 0
+        frames = []
+
+        # cell voltages of three modules per cycle
+        groups = (self.modules + 2) // 3
+        first = (cycle % groups) * 3
+        for module in range(first, min(first + 3, self.modules)):
+            v = self.cells[module * cells : (module + 1) * cells] + [0] * (4 - cells)
+            frames.append((0x350 + 2 * module, _CELLS_FIRST.pack(1, 0, *v[:3])))
+            if cells > 3:
+                frames.append((0x351 + 2 * module, _CELLS_LAST.pack(1, 0, v[3])))
+
+        # one group of module values per cycle
+        kind = cycle % 3
+        if kind == 0:
+            share = int(current * 100 / self.modules)
+            frames += self._module_frames(0x46A, 3, ">h", [share] * self.modules)
+        elif kind == 1:
+            soc = int(self.soc * 256 / 100)
+            for i in range(0, self.modules, 7):
+                count = min(7, self.modules - i)
+                frames.append((0x06A + i // 7, bytes([1] + [min(soc, 255)] * count)))
+        else:
+            temperatures = [2500 + module * 10 for module in range(self.modules)]
+            frames += self._module_frames(0x76A, 3, ">H", temperatures)
+
+        maxCell, minCell = max(self.cells), min(self.cells)
+        frames.append((0xC4, _CELL_EXTREMES.pack(65, 63, 68, maxCell, minCell)))
+        packVoltage = sum(self.cells[: self.modulesInSeries * cells]) / 1000.0
+        maxDischarge = 3000
+        maxCharge = 1500
+        frames.append(
+            (
+                0xC1,
+                _PACK.pack(
+                    int(packVoltage / 2),
+                    max(-128, min(127, current)),
+                    maxDischarge,
+                    maxCharge & 0xFF,
+                    maxCharge >> 8,
+                ),
+            )
+        )
+        frames.append(
+            (0xC0, bytes([int(self.soc), self.mode, 0, 0, 0, self.modules, 0, 0]))
+        )
+        chargeComplete = 0x4 if self.soc >= 100 else 0
+        frames.append(
+            (0xC2, _CHARGE.pack(int(self.capacity * 0.1), 3600, chargeComplete))
+        )
+        if cycle % IDENTITY_CYCLES == 0:
+            frames.append((0x180, bytes([156, 10, 38, 1, 34, 0x43, 0x4F, 0x33])))
+        return frames
+
+    def _module_frames(self, base, perFrame, fmt, values):
+        frames = []
+        for i in range(0, len(values), perFrame):
+            chunk = values[i : i + perFrame]
+            data = bytes([1, 0]) + struct.pack(fmt[0] + fmt[1] * len(chunk), *chunk)
+            frames.append((base + i // perFrame, data))
+        return frames
+
+
+class SimulatedBus(can.BusABC):
+    """
+    An in-process bus connected to a UbmsSimulator, speed is the multiple of the real frame rate
+    (0 as fast as possible). Frames sent to it are passed to the simulator as VMU commands.
+
+    """
+
+    def __init__(self, channel="simulator", speed=1.0, can_filters=None, **kwargs):
+        self.channel_info = "simulated U-BMS"
+        self.simulator = UbmsSimulator(
+            **{
+                name: kwargs.pop(name)
+                for name in ("modules", "strings", "cellsPerModule", "capacity", "seed")
+                if name in kwargs
+            }
+        )
+        self.speed = speed
+        self._pending = []
+        self._clock = time.time()
+        self._origin = (self._clock, time.monotonic())
+        self._closed = threading.Event()
+        super().__init__(channel, can_filters=can_filters, **kwargs)
+
+    def _next_frame(self):
+        if not self._pending:
+            self._clock += CYCLE
+            # the slave timeout runs on wall time, also when frames are simulated faster
+            frames = self.simulator.frames(time.monotonic())
+            # about 0.8ms between the frames of a burst, as on a real bus
+            self._pending = [
+                can.Message(
+                    timestamp=self._clock + i * 0.0008,
+                    arbitration_id=canId,
+                    is_extended_id=False,
+                    data=data,
+                )
+                for i, (canId, data) in enumerate(frames)
+            ]
+            self._pending.reverse()
+        return self._pending.pop()
+
+    def _recv_internal(self, timeout):
+        if self._closed.is_set():
+            raise can.CanOperationError("Simulated bus is shut down")
+        msg = self._next_frame()
+        while not self._matches_filters(msg):
+            msg = self._next_frame()
+        if self.speed:
+            due = self._origin[1] + (msg.timestamp - self._origin[0]) / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                if timeout is not None and delay > timeout:
+                    # keep the frame for the next call
+                    self._pending.append(msg)
+                    self._closed.wait(timeout)
+                    return None, False
+                self._closed.wait(delay)
+        return msg, True
+
+    def send(self, msg, timeout=None):
+        self.simulator.command(msg, time.monotonic())
+
+    def shutdown(self):
+        self._closed.set()
+        super().shutdown()
+
+
+# === All code below is to run the simulator on a CAN interface ===
+def main():
+    parser = ArgumentParser(description="simulate a Valence U-BMS on a CAN interface")
+    parser.add_argument("-i", "--interface", default="vcan0", help="CAN interface")
+    parser.add_argument(
+        "-m", "--modules", type=int, default=8, help="number of modules, up to 11"
+    )
+    parser.add_argument(
+        "--strings",
+        type=int,
+        help="number of parallel strings, default modules / 2 or modules if odd",
+    )
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1.0,
+        help="multiple of the real frame rate, 0 as fast as possible",
+    )
+    parser.add_argument(
+        "-d", "--debug", help="enable debug logging", action="store_true"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(levelname)-8s %(message)s",
+        level=(logging.DEBUG if args.debug else logging.INFO),
+    )
+
+    sim = UbmsSimulator(modules=args.modules, strings=args.strings)
+    bus = can.interface.Bus(
+        channel=args.interface,
+        bustype="socketcan",
+        can_filters=[{"can_id": 0x440, "can_mask": 0x7FF, "extended": False}],
+    )
+    logging.info(
+        "Simulating a U-BMS with %d modules on %s at %gx",
+        args.modules,
+        args.interface,
+        args.speed,
+    )
+
+    sent = 0
+    start = time.monotonic()
+    try:
+        while True:
+            now = time.time()
+            for canId, data in sim.frames(now):
+                try:
+                    bus.send(
+                        can.Message(
+                            arbitration_id=canId, is_extended_id=False, data=data
+                        )
+                    )
+                    sent += 1
+                except can.CanError as e:
+                    # e.g. the transmit queue is full at high speed
+                    logging.debug("Frame 0x%03X not sent: %s", canId, e)
+            # mode commands of the driver
+            msg = bus.recv(timeout=0)
+            while msg is not None:
+                sim.command(msg, now)
+                msg = bus.recv(timeout=0)
+            if args.speed:
+                time.sleep(max(0, CYCLE / args.speed - (time.time() - now)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        elapsed = time.monotonic() - start
+        logging.info(
+            "Sent %d frames in %.1fs, %.0f frames/s", sent, elapsed, sent / elapsed
+        )
+        bus.shutdown()
+
+
+if __name__ == "__main__":
+    main()